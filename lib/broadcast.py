@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+# Copyright 2014 YH Yang <yhuiyang@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+"""Resumable fan-out of a broadcast message to all devices of an app."""
+
+# python import
+import logging
+
+# GAE import
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+# local import
+from lib import gcm_http
+from models import gcm_app
+
+
+TASK_QUEUE_NAME = 'gcm-broadcast'
+TASK_URL = '/taskqueue/broadcast_fanout'
+
+# Registration ids sent by one sender task, a full multicast request.
+BATCH_SIZE = gcm_http.GCM.REGISTRATION_IDS_MAX
+# Sender tasks emitted by one fan-out task.
+SEGMENT_BATCHES = 10
+
+
+def start(package, collapse_key=None, data=None, delay_while_idle=None, time_to_live=None, dry_run=False):
+    """
+    Record a broadcast job and push its first fan-out task. Returns immediately, the devices are enumerated by the
+    fan-out tasks.
+
+    :param package: the apk package name of the app whose devices receive the message.
+    :return: the GcmBroadcastJobModel entity.
+    """
+    job = gcm_app.GcmBroadcastJobModel(package=package, collapse_key=collapse_key, data=data,
+                                       delay_while_idle=delay_while_idle, time_to_live=time_to_live, dry_run=dry_run)
+
+    @ndb.transactional
+    def _txn():
+        job.put()
+        _push_segment(job.key.id(), job.segment)
+    _txn()
+    return job
+
+
+def run_segment(job_id, segment):
+    """
+    Emit the sender tasks of one segment, then checkpoint the cursor and chain the next segment.
+
+    Running the same segment twice is harmless: sender tasks are named after (job, segment, batch), and the checkpoint
+    only moves forward from the expected segment.
+
+    :param job_id: id of the GcmBroadcastJobModel entity.
+    :param segment: the segment to run, starting from 0.
+    """
+    job = gcm_app.GcmBroadcastJobModel.get_by_id(job_id)
+    if job is None:
+        logging.error('Broadcast job %d does not exist.' % job_id)
+        return
+    if job.status != gcm_app.GcmBroadcastJobModel.STATUS_RUNNING or job.segment != segment:
+        logging.info('Broadcast job %d segment %d was done before, skip it.' % (job_id, segment))
+        return
+
+    app = gcm_app.GcmAppModel.get_cached(job.package)
+    if app is None:
+        logging.error('Broadcast job %d targets unknown app %s, abort it.' % (job_id, job.package))
+        job.status = gcm_app.GcmBroadcastJobModel.STATUS_ABORTED
+        job.put()
+        return
+
+    start_cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    registration_ids, cursor, more = gcm_app.GcmDeviceModel.fetch_registration_ids_page(
+        job.package, BATCH_SIZE * SEGMENT_BATCHES, start_cursor=start_cursor)
+
+    sender_tasks = gcm_http.TaskBatch(gcm_http.route_queue(gcm_http.PRIORITY_CAMPAIGN, job.package))
+    for batch, start_index in enumerate(range(0, len(registration_ids), BATCH_SIZE)):
+        sender_tasks.add(gcm_http.GCM.build_task(app.google_api_key,
+                                                 registration_ids[start_index:start_index + BATCH_SIZE], 0,
+                                                 data=job.data, collapse_key=job.collapse_key,
+                                                 delay_while_idle=job.delay_while_idle, time_to_live=job.time_to_live,
+                                                 dry_run=job.dry_run,
+                                                 task_name='broadcast-%d-%d-%d' % (job_id, segment, batch),
+                                                 package=job.package))
+    sender_tasks.flush()
+
+    next_cursor = cursor.urlsafe() if more and cursor is not None else None
+    _checkpoint(job.key, segment, next_cursor, len(registration_ids))
+
+
+@ndb.transactional
+def _checkpoint(job_key, segment, next_cursor, device_count):
+    job = job_key.get()
+    if job.segment != segment:
+        return
+    job.segment = segment + 1
+    job.device_count += device_count
+    if next_cursor:
+        job.cursor = next_cursor
+        _push_segment(job_key.id(), job.segment)
+    else:
+        job.status = gcm_app.GcmBroadcastJobModel.STATUS_DONE
+        logging.info('Broadcast job %d done, %d devices.' % (job_key.id(), job.device_count))
+    job.put()
+
+
+def _push_segment(job_id, segment):
+    # must be called inside a transaction, so the task exists if and only if the checkpoint is committed.
+    taskqueue.add(queue_name=TASK_QUEUE_NAME, url=TASK_URL, params={'job_id': job_id, 'segment': segment},
+                  transactional=True)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+# Copyright 2014 YH Yang <yhuiyang@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+"""Coalesce small sends of the same message into full multicast requests through a pull queue."""
+
+# python import
+import hashlib
+import json
+import logging
+import time
+
+# GAE import
+from google.appengine.api import taskqueue
+
+# local import
+from lib import gcm_http
+from models import gcm_app
+
+
+PULL_QUEUE_NAME = 'gcm-coalesce'
+# Sends pushed in the same window are sent by the same worker run.
+WINDOW_SECONDS = 5
+WORKER_URL = '/taskqueue/coalesced_sender'
+WORKER_TASK_NAME_TEMPLATE = 'coalesce-{}'
+# Items leased at once, the max of lease_tasks_by_tag().
+LEASE_MAX = 1000
+LEASE_SECONDS = 120
+# A worker stops leasing after this, and kicks another worker if items remain.
+WORKER_SECONDS = 60
+
+
+def push(api_key, registration_ids, data=None, collapse_key=None, delay_while_idle=None, time_to_live=None,
+         restricted_package_name=None, dry_run=False, package=None):
+    """
+    Queue a send to a few devices. Sends of the same message with the same api key, pushed within a few seconds, are
+    sent together by one worker in requests of up to 1000 registration ids. The message parameters are the same as
+    GCM.send().
+
+    :param package: apk package name of the app, used to route retries. (Optional)
+    """
+    if not registration_ids:
+        return
+    message_hash = gcm_http.GCM.store_message(data=data, collapse_key=collapse_key,
+                                              delay_while_idle=delay_while_idle, time_to_live=time_to_live,
+                                              restricted_package_name=restricted_package_name, dry_run=dry_run)
+    payload = json.dumps({
+        'api_key': api_key,
+        'message': message_hash,
+        'package': package,
+        'registration_ids': list(registration_ids),
+    })
+    taskqueue.Queue(PULL_QUEUE_NAME).add(taskqueue.Task(payload=payload, method='PULL',
+                                                        tag=_group_tag(api_key, message_hash)))
+    _kick_worker(int(time.time() // WINDOW_SECONDS) + 1)
+
+
+def run():
+    """
+    Lease queued sends group by group, and send every group in requests of up to 1000 registration ids. Items of a
+    group are deleted after it is sent, items of a group which failed come back when their lease expires, and a
+    worker is scheduled for then.
+    """
+    queue = taskqueue.Queue(PULL_QUEUE_NAME)
+    stop_time = time.time() + WORKER_SECONDS
+    while time.time() < stop_time:
+        # without tag, items with the same tag as the earliest item are leased
+        tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, LEASE_MAX)
+        if not tasks:
+            return
+        try:
+            _send_group(tasks)
+        except Exception as e:
+            logging.error('Coalesced send of %d items failed, retry after lease expires: %s' % (len(tasks), e))
+            _kick_worker(int((time.time() + LEASE_SECONDS) // WINDOW_SECONDS) + 1)
+            continue
+        queue.delete_tasks(tasks)
+
+    # items remain, let another worker continue
+    _kick_worker(int(time.time() // WINDOW_SECONDS) + 1)
+
+
+def _send_group(tasks):
+    items = [json.loads(task.payload) for task in tasks]
+    api_key = items[0]['api_key']
+    message_hash = items[0]['message']
+    package = items[0].get('package')
+
+    message = gcm_app.GcmMessageModel.load(message_hash)
+    if message is None:
+        logging.error('Message %s does not exist, drop %d items.' % (message_hash, len(tasks)))
+        return
+
+    # the same device may be queued twice for the same message, send it once
+    registration_ids = list()
+    seen = set()
+    for item in items:
+        for registration_id in item['registration_ids']:
+            if registration_id not in seen:
+                seen.add(registration_id)
+                registration_ids.append(registration_id)
+
+    batch_size = gcm_http.GCM.REGISTRATION_IDS_MAX
+    batches = [registration_ids[i:i + batch_size] for i in range(0, len(registration_ids), batch_size)]
+    # leased items are sent again if this run fails, name retry tasks after them so they are pushed once
+    retry_task_name = 'coalesce-' + hashlib.sha1('\n'.join(sorted(task.name for task in tasks))).hexdigest()
+
+    gcm = gcm_http.GCM(api_key, 0, package=package)
+    summary = gcm.send_many(batches, collapse_key=message.get('collapse_key'), data=message.get('data'),
+                            delay_while_idle=message.get('delay_while_idle'),
+                            time_to_live=message.get('time_to_live'),
+                            restricted_package_name=message.get('restricted_package_name'),
+                            dry_run=message.get('dry_run', False), retry_task_name=retry_task_name)
+    logging.info('%d items coalesced into %d requests, %s' % (len(tasks), len(batches), summary))
+
+
+def _group_tag(api_key, message_hash):
+    # items with the same tag are sent together, the api key isn't exposed in the tag
+    return hashlib.sha1(api_key + '\n' + message_hash).hexdigest()
+
+
+def _kick_worker(window):
+    # one worker task per window, it runs when the window closes so the sends of the window are coalesced
+    task = taskqueue.Task(url=WORKER_URL, name=WORKER_TASK_NAME_TEMPLATE.format(window),
+                          countdown=max(0, window * WINDOW_SECONDS - time.time()))
+    try:
+        task.add(queue_name=gcm_http.route_queue(gcm_http.PRIORITY_INTERACTIVE))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
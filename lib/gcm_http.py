@@ -18,10 +18,18 @@
 ##############################################################################
 
 # python import
+import hashlib
 import logging
 import json
+import random
+import time
+import urllib
+import zlib
+from email.utils import parsedate_tz, mktime_tz
 
 # GAE import
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
@@ -184,17 +192,291 @@ class DeviceMessageRateExceededException(Exception):
     pass
 
 
+# Map error code in the results array to the exception describing it.
+# See http://developer.android.com/google/gcm/http.html#error_codes
+ERROR_CODE_EXCEPTIONS = {
+    'MissingRegistration': MissingRegistrationIdException,
+    'InvalidRegistration': InvalidRegistrationIdException,
+    'MismatchSenderId': MismatchedSenderException,
+    'NotRegistered': UnregisteredDeviceException,
+    'MessageTooBig': MessageTooBigException,
+    'InvalidDataKey': InvalidDataKeyException,
+    'InvalidTtl': InvalidTimeToLifeException,
+    'Unavailable': TimeoutException,
+    'InternalServerError': InternalServerErrorException,
+    'InvalidPackageName': InvalidPackageNameException,
+    'DeviceMessageRateExceeded': DeviceMessageRateExceededException,
+}
+
+
+def parse_retry_after(value):
+    """
+    Parse the Retry-After header, which is either a number of seconds or a HTTP-date.
+
+    :param value: value of the Retry-After header, None if the header is absent.
+    :return: seconds to wait from now, or None if value is absent or malformed.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date_tuple = parsedate_tz(value)
+    if date_tuple is None:
+        logging.warning('Malformed Retry-After header: %s' % value)
+        return None
+    return max(0, int(mktime_tz(date_tuple) - time.time()))
+
+
+# Sender tasks carry registration ids in the task body, the header tells how the body is encoded.
+REGISTRATION_IDS_FORMAT_HEADER = 'X-Gcm-Registration-Ids-Format'
+REGISTRATION_IDS_FORMAT_ZLIB_V1 = 'zlib-1'  # zlib compressed, newline joined, utf-8 registration ids
+
+
+def encode_registration_ids(registration_ids):
+    """
+    Encode registration ids into a task body in REGISTRATION_IDS_FORMAT_ZLIB_V1 format.
+    """
+    return zlib.compress(u'\n'.join(registration_ids).encode('utf-8'))
+
+
+def decode_registration_ids(body, registration_ids_format):
+    """
+    Decode registration ids from a task body encoded by encode_registration_ids().
+
+    :param body: the task body.
+    :param registration_ids_format: value of the REGISTRATION_IDS_FORMAT_HEADER header.
+    :return: list of registration ids.
+    """
+    if registration_ids_format != REGISTRATION_IDS_FORMAT_ZLIB_V1:
+        raise ValueError('Unknown registration ids format: %s' % registration_ids_format)
+    return zlib.decompress(body).decode('utf-8').split(u'\n')
+
+
+# Priorities of sender tasks, every priority has its own queue so urgent sends are not stuck behind campaign backlog.
+PRIORITY_INTERACTIVE = 'interactive'  # sends to a few devices, someone is waiting for them
+PRIORITY_CAMPAIGN = 'campaign'  # broadcast fan-out
+PRIORITY_RETRY = 'retry'  # retries of failed registration ids, already delayed by back-off
+
+# Default queue of every priority, see queue.yaml. An app overrides them by GcmAppModel.sender_queues.
+SENDER_QUEUES = {
+    PRIORITY_INTERACTIVE: 'gcm-sender-interactive',
+    PRIORITY_CAMPAIGN: 'gcm-sender-campaign',
+    PRIORITY_RETRY: 'gcm-sender-retry',
+}
+
+
+def route_queue(priority, package=None):
+    """
+    Pick the queue of sender tasks.
+
+    :param priority: one of PRIORITY_INTERACTIVE, PRIORITY_CAMPAIGN and PRIORITY_RETRY.
+    :param package: apk package name of the app, whose sender_queues overrides the default queue. (Optional)
+    :return: queue name.
+    """
+    if priority not in SENDER_QUEUES:
+        raise ValueError('Unknown priority: %s' % priority)
+    if package is not None:
+        app = gcm_app.GcmAppModel.get_cached(package)
+        if app is not None and app.sender_queues and app.sender_queues.get(priority):
+            return app.sender_queues[priority]
+    return SENDER_QUEUES[priority]
+
+
+class RegistrationResult(object):
+    """
+    Outcome of sending a message to one registration id.
+    """
+    SUCCESS = 'success'  # message accepted
+    CANONICAL = 'canonical'  # message accepted, but the device should be addressed by canonical_id from now on
+    UNREGISTERED = 'unregistered'  # device is gone, stop sending message to it
+    RETRYABLE = 'retryable'  # send again later
+    DEFERRED = 'deferred'  # not sent, held back by SendGovernor
+    ERROR = 'error'  # permanent error, see error for the reason
+
+    def __init__(self, registration_id, outcome, canonical_id=None, error=None):
+        self.registration_id = registration_id
+        self.outcome = outcome
+        self.canonical_id = canonical_id
+        self.error = error
+
+    def __repr__(self):
+        return 'RegistrationResult(%s, %s, canonical_id=%s, error=%s)' % (self.registration_id, self.outcome,
+                                                                          self.canonical_id, self.error)
+
+
+class SendSummary(object):
+    """
+    Per registration id results collected from the responses of one or more batches sent by GCM.send_many().
+    """
+
+    def __init__(self):
+        self.results = list()
+        self.suggested_try_after = None
+        self.deferred_try_after = None
+
+    def add(self, registration_id, outcome, canonical_id=None, error=None):
+        self.results.append(RegistrationResult(registration_id, outcome, canonical_id=canonical_id, error=error))
+
+    def suggest_try_after(self, seconds):
+        # honor the longest Retry-After among all batches
+        if seconds is None:
+            return
+        if self.suggested_try_after is None or seconds > self.suggested_try_after:
+            self.suggested_try_after = seconds
+
+    def count(self, outcome):
+        return len([r for r in self.results if r.outcome == outcome])
+
+    def error_counts(self):
+        """
+        :return: a dict mapping error code to the number of registration ids failed with it.
+        """
+        counts = dict()
+        for r in self.results:
+            if r.outcome == RegistrationResult.ERROR:
+                counts[r.error] = counts.get(r.error, 0) + 1
+        return counts
+
+    @property
+    def replaced_registration_ids(self):
+        # list of (old registration id, canonical id) tuple
+        return [(r.registration_id, r.canonical_id) for r in self.results
+                if r.outcome == RegistrationResult.CANONICAL]
+
+    @property
+    def disabled_registration_ids(self):
+        return [r.registration_id for r in self.results if r.outcome == RegistrationResult.UNREGISTERED]
+
+    @property
+    def failed_registration_ids(self):
+        return [r.registration_id for r in self.results if r.outcome == RegistrationResult.RETRYABLE]
+
+    @property
+    def deferred_registration_ids(self):
+        return [r.registration_id for r in self.results if r.outcome == RegistrationResult.DEFERRED]
+
+    def __str__(self):
+        return 'success: %d, canonical: %d, unregistered: %d, retryable: %d, deferred: %d, error: %s' % (
+            self.count(RegistrationResult.SUCCESS), self.count(RegistrationResult.CANONICAL),
+            self.count(RegistrationResult.UNREGISTERED), self.count(RegistrationResult.RETRYABLE),
+            self.count(RegistrationResult.DEFERRED), self.error_counts())
+
+
+class SendGovernor(object):
+    """
+    Limit the registration ids sent by one api key across all instances, so a sender doesn't get throttled or
+    blacklisted by GCM. Sent and Unavailable (including 5xx and timeouts) registration ids are counted by memcache
+    counters of 10 seconds buckets, and a sliding window of one minute is estimated from them, weighting the oldest
+    bucket by the part of it still inside the window.
+
+    A batch is deferred when the sender exceeds its rate, or when too many registration ids came back Unavailable
+    recently. Counters are read once per GCM.send_many() call. If memcache is unavailable, everything is admitted.
+    """
+
+    KEY_TEMPLATE = 'gcm-governor-{}-{}-{}'  # sender, counter, bucket index
+    BUCKET_SECONDS = 10
+    WINDOW_BUCKETS = 6
+    RATE_PER_MINUTE = 60000  # registration ids of one api key, GcmAppModel.send_rate_per_minute overrides it
+    UNAVAILABLE_RATIO_MAX = 0.2
+    UNAVAILABLE_SAMPLE_MIN = 100  # don't judge the ratio from a few registration ids
+    BACK_OFF_SECONDS = 60
+
+    def __init__(self, api_key, rate_per_minute=None):
+        # the api key isn't exposed in memcache keys
+        self.sender = hashlib.sha1(api_key).hexdigest()
+        self.rate_per_minute = rate_per_minute or SendGovernor.RATE_PER_MINUTE
+        self.sent = None
+        self.unavailable = None
+        self.admitted = 0
+
+    def admit(self, count):
+        """
+        :param count: registration ids of the batch.
+        :return: 0 if the batch is admitted, otherwise seconds to defer it.
+        """
+        if self.sent is None:
+            self.sent, self.unavailable = self._read_window()
+        if self.sent >= SendGovernor.UNAVAILABLE_SAMPLE_MIN and \
+                self.unavailable > self.sent * SendGovernor.UNAVAILABLE_RATIO_MAX:
+            return SendGovernor.BACK_OFF_SECONDS
+        # a batch larger than the rate is admitted alone, so it is not deferred forever
+        if self.sent > 0 and self.sent + count > self.rate_per_minute:
+            return SendGovernor.BUCKET_SECONDS
+        self.sent += count
+        self.admitted += count
+        return 0
+
+    def commit(self):
+        """
+        Count the admitted registration ids, call it before sending so concurrent senders see them.
+        """
+        if self.admitted:
+            self._incr(self._key('sent', self._bucket_index()), self.admitted)
+            self.admitted = 0
+
+    def record(self, summary):
+        """
+        Count the Unavailable registration ids of the sent batches.
+        """
+        unavailable = summary.count(RegistrationResult.RETRYABLE)
+        if unavailable:
+            self._incr(self._key('unavailable', self._bucket_index()), unavailable)
+
+    @staticmethod
+    def _incr(memcache_key, delta):
+        # buckets expire once they leave the window, so they don't push other entries out of memcache
+        if memcache.incr(memcache_key, delta=delta) is None:
+            if not memcache.add(memcache_key, delta,
+                                time=SendGovernor.BUCKET_SECONDS * (SendGovernor.WINDOW_BUCKETS + 2)):
+                memcache.incr(memcache_key, delta=delta)
+
+    def _read_window(self):
+        now = time.time()
+        index = self._bucket_index(now)
+        indices = range(index - SendGovernor.WINDOW_BUCKETS, index + 1)
+        keys = [self._key(counter, i) for counter in ('sent', 'unavailable') for i in indices]
+        values = memcache.get_multi(keys)
+        # part of the oldest bucket still inside the window
+        oldest_weight = 1 - (now % SendGovernor.BUCKET_SECONDS) / float(SendGovernor.BUCKET_SECONDS)
+        counts = list()
+        for counter in ('sent', 'unavailable'):
+            total = 0
+            for i in indices:
+                value = int(values.get(self._key(counter, i)) or 0)
+                total += value * oldest_weight if i == indices[0] else value
+            counts.append(int(total))
+        return counts[0], counts[1]
+
+    def _key(self, counter, index):
+        return SendGovernor.KEY_TEMPLATE.format(self.sender, counter, index)
+
+    @staticmethod
+    def _bucket_index(now=None):
+        return int((time.time() if now is None else now) // SendGovernor.BUCKET_SECONDS)
+
+
 class GCM:
 
     URL = 'https://android.googleapis.com/gcm/send'
-    TASK_QUEUE_NAME = 'gcm-sender'
     RETRY_INTERVAL_INITIAL = 10  # unit in second
     RETRY_INTERVAL_MAX = 300
     RETRY_MAX = 5
+    COALESCE_IDS_MAX = 100  # interactive sends to at most this many devices are coalesced, see push_to_task_queue()
+    DEFERRALS_MAX = 30  # a batch deferred this many times is sent without asking SendGovernor
+    RETRY_JITTER_RATIO = 0.5  # random delay up to this ratio of the back-off interval
+    REGISTRATION_IDS_MAX = 1000  # max registration ids in one multicast request
+    DEADLINE = 30  # unit in second
 
-    def __init__(self, api_key, try_count):
+    def __init__(self, api_key, try_count, package=None, deferrals=0):
+        """
+        :param package: apk package name of the app, used to route retry tasks. (Optional)
+        :param deferrals: how many times SendGovernor deferred the registration ids before. (Optional)
+        """
         self.api_key = api_key
         self.try_count = try_count
+        self.package = package
+        self.deferrals = deferrals
 
     def send(self, registration_ids, collapse_key=None, data=None, delay_while_idle=None, time_to_live=None,
              restricted_package_name=None, dry_run=False):
@@ -219,18 +501,51 @@ class GCM:
         :param restricted_package_name: a string containing the package name of your application. When set, messages
          are only sent to registration IDs that match the package name. (Optional)
         :param dry_run: allows developers to test a request without actually sending a message. (Optional)
-        :return: nothing
+        :return: a SendSummary holding the result of every registration id.
+        """
+        return self.send_many([registration_ids], collapse_key=collapse_key, data=data,
+                              delay_while_idle=delay_while_idle, time_to_live=time_to_live,
+                              restricted_package_name=restricted_package_name, dry_run=dry_run)
+
+    def send_many(self, batches, collapse_key=None, data=None, delay_while_idle=None, time_to_live=None,
+                  restricted_package_name=None, dry_run=False, retry_task_name=None):
+        """
+        Send the same message to several batches of registration ids. One urlfetch rpc is started for every batch, so
+        all requests are in flight at the same time, and the responses are handled in the order they complete.
+
+        Canonical ids, NotRegistered and Unavailable results of all batches are aggregated, so the data store update
+        and the retry task are issued only once no matter how many batches we send. A registration id with a
+        permanent error (ex: InvalidRegistration) is only recorded in the returned summary, it doesn't affect the
+        other registration ids.
+
+        Batches are admitted by the SendGovernor of the api key first. Deferred batches are pushed to task queue again
+        with the same try count, delayed until the governor expects to admit them.
+
+        :param batches: a list or tuple of registration id batches. Every batch follows the same rules as the
+         registration_ids parameter of send(). (Required)
+        :param collapse_key: see send(). (Optional)
+        :param data: see send(). (Optional)
+        :param delay_while_idle: see send(). (Optional)
+        :param time_to_live: see send(). (Optional)
+        :param restricted_package_name: see send(). (Optional)
+        :param dry_run: see send(). (Optional)
+        :param retry_task_name: prefix of the names of retry tasks. Pass the name of the current task, so running the
+         same task twice doesn't push duplicate retry tasks. (Optional)
+        :return: a SendSummary holding the result of every registration id of all batches.
         """
 
         # ###########################################################################################################
         # verify parameters
         # ###########################################################################################################
-        # registration_ids needs to be list or tuple, and size between 1 and 1000.
-        if registration_ids is None or (not isinstance(registration_ids, list) and not isinstance(registration_ids,
-                                                                                                  tuple)):
-            raise TypeError('registration_ids needs to be tuple or list.')
-        elif not (1 <= len(registration_ids) <= 1000):
-            raise ValueError('registration_ids can only contains 1 to 1000 registration id.')
+        if batches is None or (not isinstance(batches, list) and not isinstance(batches, tuple)):
+            raise TypeError('batches needs to be tuple or list.')
+        for registration_ids in batches:
+            # registration_ids needs to be list or tuple, and size between 1 and 1000.
+            if registration_ids is None or (not isinstance(registration_ids, list) and
+                                            not isinstance(registration_ids, tuple)):
+                raise TypeError('registration_ids needs to be tuple or list.')
+            elif not (1 <= len(registration_ids) <= GCM.REGISTRATION_IDS_MAX):
+                raise ValueError('registration_ids can only contains 1 to 1000 registration id.')
 
         # collapse_key needs to be str or unicode if set
         if collapse_key is not None:
@@ -266,186 +581,428 @@ class GCM:
             raise TypeError('dry_run needs to be bool value, but get %s' % type(dry_run))
 
         # ###########################################################################################################
-        # construct request (header + body)
+        # construct request (header + body), every batch shares the same header and message fields
         # ###########################################################################################################
         gcm_headers = {
             'Content-Type': 'application/json',
             'Authorization': 'key=' + self.api_key,
         }
 
-        gcm_body = {
-            'registration_ids': registration_ids
-        }
+        gcm_message = dict()
         if collapse_key:
-            gcm_body['collapse_key'] = collapse_key
+            gcm_message['collapse_key'] = collapse_key
         if data:
-            gcm_body['data'] = data
+            gcm_message['data'] = data
         if delay_while_idle is not None:
-            gcm_body['delay_while_idle'] = delay_while_idle
+            gcm_message['delay_while_idle'] = delay_while_idle
         if time_to_live is not None:
-            gcm_body['time_to_live'] = time_to_live
+            gcm_message['time_to_live'] = time_to_live
         if restricted_package_name is not None:
-            gcm_body['restricted_package_name'] = restricted_package_name
+            gcm_message['restricted_package_name'] = restricted_package_name
         if dry_run:
-            gcm_body['dry_run'] = True
+            gcm_message['dry_run'] = True
 
         logging.debug('Headers: %s' % gcm_headers)
-        logging.debug('Body: %s' % gcm_body)
+        logging.debug('Message: %s' % gcm_message)
 
         # ###########################################################################################################
-        # Send request and handle response
+        # Ask the governor of this api key which batches may be sent now
         # ###########################################################################################################
+        summary = SendSummary()
+        governor = self._governor()
+        admitted_batches = list()
+        if self.deferrals >= GCM.DEFERRALS_MAX:
+            logging.warning('Registration ids were deferred %d times, send them anyway.' % self.deferrals)
+        for registration_ids in batches:
+            if self.deferrals >= GCM.DEFERRALS_MAX:
+                defer_seconds = 0
+                governor.admitted += len(registration_ids)
+            else:
+                defer_seconds = governor.admit(len(registration_ids))
+            if defer_seconds:
+                self._add_batch_result(summary, registration_ids, RegistrationResult.DEFERRED, None)
+                if summary.deferred_try_after is None or defer_seconds > summary.deferred_try_after:
+                    summary.deferred_try_after = defer_seconds
+            else:
+                admitted_batches.append(registration_ids)
+        governor.commit()
+
+        # ###########################################################################################################
+        # Start all requests, then handle responses as they complete
+        # ###########################################################################################################
+        rpc_batches = dict()
+        for registration_ids in admitted_batches:
+            gcm_body = dict(gcm_message)
+            gcm_body['registration_ids'] = registration_ids
+            rpc = urlfetch.create_rpc(deadline=GCM.DEADLINE)
+            urlfetch.make_fetch_call(rpc, GCM.URL, payload=json.dumps(gcm_body), method=urlfetch.POST,
+                                     headers=gcm_headers, follow_redirects=False, validate_certificate=True)
+            rpc_batches[rpc] = registration_ids
+
+        first_error = None
+        pending_rpcs = list(rpc_batches)
+        while pending_rpcs:
+            rpc = apiproxy_stub_map.UserRPC.wait_any(pending_rpcs)
+            pending_rpcs.remove(rpc)
+            try:
+                self._handle_rpc(rpc, rpc_batches[rpc], summary)
+            except Exception as e:
+                # Keep handling the other batches, their results are still valid. Raise the error after the deferred
+                # actions are done.
+                logging.error('Batch of %d registration ids failed: %s' % (len(rpc_batches[rpc]), e))
+                if first_error is None:
+                    first_error = e
+
+        governor.record(summary)
+
+        # ###########################################################################################################
+        # Run the deferred actions
+        # ###########################################################################################################
+        # 1. data store operations, started asynchronously so they overlap with the retry scheduling.
+        put_futures = self._update_devices_async(summary)
+
+        # 2. retry failed device, one task per batch so every batch gets its own random delay
+        failed_registration_ids = summary.failed_registration_ids
+        retry_tasks = TaskBatch(route_queue(PRIORITY_RETRY, self.package))
+        for index, start in enumerate(range(0, len(failed_registration_ids), GCM.REGISTRATION_IDS_MAX)):
+            if retry_task_name is not None:
+                task_name = '%s-retry%d-%d' % (retry_task_name, self.try_count + 1, index)
+            else:
+                task_name = None
+            retry_tasks.add(self.build_task(self.api_key,
+                                            failed_registration_ids[start:start + GCM.REGISTRATION_IDS_MAX],
+                                            self.try_count + 1, suggested_try_after=summary.suggested_try_after,
+                                            data=data, collapse_key=collapse_key, delay_while_idle=delay_while_idle,
+                                            time_to_live=time_to_live,
+                                            restricted_package_name=restricted_package_name, dry_run=dry_run,
+                                            task_name=task_name, package=self.package))
+
+        # deferred batches are not failures, they are pushed again without counting a try
+        deferred_registration_ids = summary.deferred_registration_ids
+        for index, start in enumerate(range(0, len(deferred_registration_ids), GCM.REGISTRATION_IDS_MAX)):
+            if retry_task_name is not None:
+                # hashed, so names don't grow with every deferral
+                task_name = 'deferred-' + hashlib.sha1('%s-%d-%d' % (retry_task_name, self.deferrals + 1,
+                                                                     index)).hexdigest()
+            else:
+                task_name = None
+            retry_tasks.add(self.build_task(self.api_key,
+                                            deferred_registration_ids[start:start + GCM.REGISTRATION_IDS_MAX],
+                                            self.try_count, suggested_try_after=summary.deferred_try_after,
+                                            data=data, collapse_key=collapse_key, delay_while_idle=delay_while_idle,
+                                            time_to_live=time_to_live,
+                                            restricted_package_name=restricted_package_name, dry_run=dry_run,
+                                            task_name=task_name, package=self.package,
+                                            deferrals=self.deferrals + 1))
+        retry_tasks.flush()
+
+        # 3. permanent errors, logged once per error code instead of failing the whole batch
+        for error, count in summary.error_counts().items():
+            logging.error('%d registration ids failed with %s' % (count, error))
+
+        ndb.Future.wait_all(put_futures)
+
+        if first_error is not None:
+            raise first_error
+        return summary
+
+    def _governor(self):
+        rate_per_minute = None
+        if self.package is not None:
+            app = gcm_app.GcmAppModel.get_cached(self.package)
+            if app is not None:
+                rate_per_minute = app.send_rate_per_minute
+        return SendGovernor(self.api_key, rate_per_minute=rate_per_minute)
+
+    @staticmethod
+    def _update_devices_async(summary):
+        """
+        Disable the devices which got canonical ids or NotRegistered, and create the devices for the canonical ids.
+        All affected devices are read by one get_multi and written back by one put_multi.
+
+        :param summary: a SendSummary collecting the results of all batches.
+        :return: list of futures of the put_multi_async, empty list if there is nothing to write.
+        """
+        replaced_registration_ids = summary.replaced_registration_ids
+        disabled_registration_ids = summary.disabled_registration_ids
+        old_registration_ids = [old_registration_id for old_registration_id, _ in replaced_registration_ids]
+        old_registration_ids += disabled_registration_ids
+        if not old_registration_ids:
+            return list()
+
+        keys = [ndb.Key(gcm_app.GcmDeviceModel, registration_id) for registration_id in old_registration_ids]
+        old_entities = dict()
+        for key, future in zip(keys, ndb.get_multi_async(keys)):
+            entity = future.get_result()
+            if entity is None:
+                logging.warning('Device %s does not exist, skip updating it.' % key.string_id())
+            else:
+                old_entities[key.string_id()] = entity
+
+        entities = list()
+        for old_registration_id, new_canonical_id in replaced_registration_ids:
+            old_entity = old_entities.get(old_registration_id)
+            if old_entity is None:
+                continue
+            old_entity.enabled = False
+            new_entity = gcm_app.GcmDeviceModel(id=new_canonical_id)
+            new_entity.package = old_entity.package
+            new_entity.version = old_entity.version
+            new_entity.uuid = old_entity.uuid
+            entities.append(new_entity)
+        for disable_registration_id in disabled_registration_ids:
+            disabled_entity = old_entities.get(disable_registration_id)
+            if disabled_entity is not None:
+                disabled_entity.enabled = False
+        entities += old_entities.values()
+
+        return ndb.put_multi_async(entities)
+
+    def _handle_rpc(self, rpc, registration_ids, summary):
+        """
+        Interpret the response of one batch and record the result of every registration id into summary.
+
+        :param rpc: the completed urlfetch rpc.
+        :param registration_ids: the registration ids sent by this rpc.
+        :param summary: a SendSummary collecting the results of all batches.
+        """
         try:
-            response = urlfetch.fetch(GCM.URL, payload=json.dumps(gcm_body), method=urlfetch.POST, headers=gcm_headers,
-                                      deadline=30, follow_redirects=False, validate_certificate=True)
+            response = rpc.get_result()
             if response.status_code == 200:
                 # See how to interpret a success response (http://developer.android.com/google/gcm/http.html#success)
                 response_dict = json.loads(response.content)
                 logging.debug('response: %s' % response_dict)
                 failure_count = response_dict['failure']
                 canonical_ids_count = response_dict['canonical_ids']
-                if failure_count or canonical_ids_count:  # do nothing if both failure and canonical_ids are 0.
-                    defer_failed_registration_ids = list()
-                    defer_replaced_registration_ids = list()
-                    defer_disabled_registration_ids = list()
-                    results_mapping_list = zip(response_dict['results'], registration_ids)
-                    for results_mapping in results_mapping_list:
-                        # results_mapping should look likes below tuple:
-                        # ({'message_id': 'fake_message_id', 'error': 'whats wrong', 'registration_id': 'canonical_id'},
-                        #  registration_id)
-                        # results_mapping[0] is results dictionary
-                        # results_mapping[1] is registration_id unicode string
-                        # Note: all db update operations () defer out of this loop
-                        if 'message_id' in results_mapping[0]:
-                            if 'registration_id' in results_mapping[0]:
+                if not failure_count and not canonical_ids_count:
+                    for registration_id in registration_ids:
+                        summary.add(registration_id, RegistrationResult.SUCCESS)
+                else:
+                    for result, registration_id in zip(response_dict['results'], registration_ids):
+                        # result should look likes below dictionary:
+                        # {'message_id': 'fake_message_id', 'error': 'whats wrong', 'registration_id': 'canonical_id'}
+                        # Note: all db update operations defer out of this loop
+                        if 'message_id' in result:
+                            if 'registration_id' in result:
                                 # create new device entity and make old device entity disabled.
-                                defer_replaced_registration_ids.append((results_mapping[1],
-                                                                        results_mapping[0]['registration_id']))
-                        elif 'error' in results_mapping[0]:
-                            error = results_mapping[0]['error']
-                            if error == 'Unavailable':
-                                defer_failed_registration_ids.append(results_mapping[1])
+                                summary.add(registration_id, RegistrationResult.CANONICAL,
+                                            canonical_id=result['registration_id'])
+                            else:
+                                summary.add(registration_id, RegistrationResult.SUCCESS)
+                        else:
+                            error = result.get('error')
+                            if error in ('Unavailable', 'InternalServerError'):
+                                # retry (obeying the requirements listed in TimeoutException)
+                                summary.add(registration_id, RegistrationResult.RETRYABLE, error=error)
                             elif error == 'NotRegistered':
                                 # mark this old device entity disabled.
-                                defer_disabled_registration_ids.append(results_mapping[1])
-                            # The following errors may be non-recoverable. See how to interpret an error response.
-                            # http://developer.android.com/google/gcm/http.html#error_codes
-                            elif error == 'MissingRegistration':
-                                raise MissingRegistrationIdException('Miss registration id in the request.')
-                            elif error == 'InvalidRegistration':
-                                raise InvalidRegistrationIdException('Invalid registration id in the request.')
-                            elif error == 'MismatchSenderId':
-                                raise MismatchedSenderException('Sender is mismatched.')
-                            elif error == 'MessageTooBig':
-                                raise MessageTooBigException('Message is too big.')
-                            elif error == 'InvalidDataKey':
-                                raise InvalidDataKeyException('Data key is invalid. (Probably use reserved keywords)')
-                            elif error == 'InvalidTtl':
-                                raise InvalidTimeToLifeException('time_to_life is out of range, [0, 2419200].')
-                            elif error == 'InternalServerError':
-                                raise InternalServerErrorException('Internal server error.')
-                                # retry
-                            elif error == 'InvalidPackageName':
-                                raise InvalidPackageNameException('Invalid package name.')
-                            elif error == 'DeviceMessageRateExceeded':
-                                raise DeviceMessageRateExceededException('Device message rate exceeded.')
+                                summary.add(registration_id, RegistrationResult.UNREGISTERED, error=error)
                             else:
-                                # TODO: probably a non-recoverable error happened,
-                                logging.error('Google GCM server sends back error that we do not handle: ' + error)
-
-                    # Run the deferred actions
-                    # 1. data store operations
-                    entities = list()
-                    for old_registration_id, new_canonical_id in defer_replaced_registration_ids:
-                        old_entity = gcm_app.GcmDeviceModel.get_instance(old_registration_id)
-                        old_entity.enabled = False
-                        new_entity = gcm_app.GcmDeviceModel(id=new_canonical_id)
-                        new_entity.package = old_entity.package
-                        new_entity.version = old_entity.version
-                        new_entity.uuid = old_entity.uuid
-                        entities.append(old_entity)
-                        entities.append(new_entity)
-                    for disable_registration_id in defer_disabled_registration_ids:
-                        disabled_entity = gcm_app.GcmDeviceModel.get_instance(disable_registration_id)
-                        disabled_entity.enabled = False
-                        entities.append(disabled_entity)
-                    ndb.put_multi(entities)
-
-                    # 2. retry failed device
-                    if len(defer_failed_registration_ids):
-                        if 'Retry-After' in response.headers:
-                            suggested_try_after = int(response.headers.get('Retry-After'))
-                        else:
-                            suggested_try_after = None
-                        self.push_to_task_queue(self.api_key, defer_failed_registration_ids, self.try_count + 1,
-                                                suggested_try_after=suggested_try_after, data=data,
-                                                collapse_key=collapse_key, delay_while_idle=delay_while_idle,
-                                                time_to_live=time_to_live,
-                                                restricted_package_name=restricted_package_name, dry_run=dry_run)
+                                # The other errors are non-recoverable for this registration id, but the rest of the
+                                # batch is not affected. See ERROR_CODE_EXCEPTIONS for the meaning of each error.
+                                if error not in ERROR_CODE_EXCEPTIONS:
+                                    logging.error('Google GCM server sends back error that we do not handle: %s' %
+                                                  error)
+                                summary.add(registration_id, RegistrationResult.ERROR, error=error)
+
+                    summary.suggest_try_after(parse_retry_after(response.headers.get('Retry-After')))
 
             elif response.status_code == 400:
                 # This indicates that the request could not be parsed as JSON, or it contained invalid fields
                 # (for instance, passing a string where a number was expected). The exact failure reason is described
                 # in the response content and the problem should be addressed before the request can be retried.
                 logging.error(response.content)
+                self._add_batch_result(summary, registration_ids, RegistrationResult.ERROR, 'HttpStatus400')
             elif response.status_code == 401:
                 raise AuthenticationErrorException('If you sure your api key is valid and sender server is whitelisted,'
                                                    ' then maybe GCM service is disable.')
             elif 500 <= response.status_code <= 599:
-                # Similar to handle for 'Unavailable'.
+                # Similar to handle for 'Unavailable', retry the whole batch.
                 logging.error('Google http connection server responses status code: %d' % response.status_code)
+                self._add_batch_result(summary, registration_ids, RegistrationResult.RETRYABLE,
+                                       'HttpStatus%d' % response.status_code)
+                summary.suggest_try_after(parse_retry_after(response.headers.get('Retry-After')))
             else:
                 logging.warning('unexpected status code: %d' % response.status_code)
+                self._add_batch_result(summary, registration_ids, RegistrationResult.ERROR,
+                                       'HttpStatus%d' % response.status_code)
         except urlfetch.InvalidURLError:
             logging.error('Invalid url! This should not happen.')
+            self._add_batch_result(summary, registration_ids, RegistrationResult.ERROR, 'InvalidURLError')
         except urlfetch.ResponseTooLargeError:
             logging.error('Response is too large. Try reducing size of registration_ids.')
+            self._add_batch_result(summary, registration_ids, RegistrationResult.ERROR, 'ResponseTooLargeError')
         except urlfetch.DeadlineExceededError:
-            logging.error('Deadline exceeded! What is different with Download Error?')
+            logging.error('Deadline exceeded! Retry the whole batch.')
+            self._add_batch_result(summary, registration_ids, RegistrationResult.RETRYABLE, 'DeadlineExceededError')
         except urlfetch.DownloadError:
-            logging.error('Google http connection server did not response in time.')
-            # TODO retry?
+            logging.error('Google http connection server did not response in time. Retry the whole batch.')
+            self._add_batch_result(summary, registration_ids, RegistrationResult.RETRYABLE, 'DownloadError')
         except urlfetch.SSLCertificateError:
             logging.error('SSL certificate error? change validate_certificate to False?')
+            self._add_batch_result(summary, registration_ids, RegistrationResult.ERROR, 'SSLCertificateError')
+
+    @staticmethod
+    def _add_batch_result(summary, registration_ids, outcome, error):
+        # the whole batch failed with the same error
+        for registration_id in registration_ids:
+            summary.add(registration_id, outcome, error=error)
 
     @staticmethod
     def push_to_task_queue(api_key, registration_ids, try_count, suggested_try_after=None, data=None, collapse_key=None,
-                           delay_while_idle=None, time_to_live=None, restricted_package_name=None, dry_run=False):
+                           delay_while_idle=None, time_to_live=None, restricted_package_name=None, dry_run=False,
+                           task_name=None, package=None, priority=PRIORITY_INTERACTIVE):
+        """
+        Push a send request to task queue, the task will be executed by TaskQueueGcmSender in taskqueue module. The
+        parameters are the same as GCM.build_task(). Use TaskBatch to push many tasks.
+
+        A first try of an interactive send to at most COALESCE_IDS_MAX devices is queued by coalesce.push() instead,
+        so small sends of the same message are sent together in one multicast request.
+
+        :param priority: picks the queue together with package, see route_queue(). (Optional)
+        """
+        if priority == PRIORITY_INTERACTIVE and try_count == 0 and task_name is None and \
+                isinstance(registration_ids, (list, tuple)) and 0 < len(registration_ids) <= GCM.COALESCE_IDS_MAX:
+            # imported here, coalesce imports this module
+            from lib import coalesce
+            coalesce.push(api_key, registration_ids, data=data, collapse_key=collapse_key,
+                          delay_while_idle=delay_while_idle, time_to_live=time_to_live,
+                          restricted_package_name=restricted_package_name, dry_run=dry_run, package=package)
+            return
+
+        task = GCM.build_task(api_key, registration_ids, try_count, suggested_try_after=suggested_try_after, data=data,
+                              collapse_key=collapse_key, delay_while_idle=delay_while_idle,
+                              time_to_live=time_to_live, restricted_package_name=restricted_package_name,
+                              dry_run=dry_run, task_name=task_name, package=package)
+        if task is None:
+            return
+        try:
+            task.add(queue_name=route_queue(priority, package))
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.info('Task %s was pushed before, skip it.' % task_name)
+
+    @staticmethod
+    def build_task(api_key, registration_ids, try_count, suggested_try_after=None, data=None, collapse_key=None,
+                   delay_while_idle=None, time_to_live=None, restricted_package_name=None, dry_run=False,
+                   task_name=None, package=None, deferrals=0):
+        """
+        Build a send request task for TaskQueueGcmSender in taskqueue module. The message parameters are the same as
+        GCM.send().
+
+        :param suggested_try_after: seconds from the Retry-After header. The task is delayed by the longer of it and
+         the exponential back-off of try_count. (Optional)
+        :param task_name: a name for the task. When given, pushing the same name twice only creates one task, so
+         callers which may run more than once (ex: a retried broadcast segment) do not send duplicate messages.
+         (Optional)
+        :param package: apk package name of the app, carried by the task so its retries are routed to the queues of
+         the app. (Optional)
+        :param deferrals: how many times SendGovernor deferred the registration ids, see GCM.DEFERRALS_MAX.
+         (Optional)
+        :return: a taskqueue.Task, or None if there is nothing to send.
+        """
 
         if not isinstance(registration_ids, tuple) and not isinstance(registration_ids, list):
             logging.error('registration_ids is expected as list or tuple type, abort to push to task queue.')
-            return
+            return None
         elif len(registration_ids) == 0:
             logging.error('registration_ids is emptied, abort to push to task queue.')
-            return
+            return None
         elif try_count > GCM.RETRY_MAX:
             logging.error('Exceeded max retries count, abort to push to task queue.')
-            return
-        elif suggested_try_after is not None:
+            return None
+
+        # exponential back-off, plus a random delay so retried batches are not sent at the same time.
+        try_after = 0 if try_count == 0 else GCM.RETRY_INTERVAL_INITIAL * (2 ** (try_count - 1))
+        if try_after > GCM.RETRY_INTERVAL_MAX:
+            try_after = GCM.RETRY_INTERVAL_MAX
+        if suggested_try_after is not None and suggested_try_after > try_after:
             # honor suggested try after
             try_after = suggested_try_after
-        else:
-            try_after = 0 if try_count is 0 else GCM.RETRY_INTERVAL_INITIAL * (2 ** (try_count - 1))
-            if try_after > GCM.RETRY_INTERVAL_MAX:
-                try_after = GCM.RETRY_INTERVAL_MAX
+        try_after += random.uniform(0, try_after * GCM.RETRY_JITTER_RATIO)
 
+        # the message is stored once, and the task only carries its hash.
+        message_hash = GCM.store_message(data=data, collapse_key=collapse_key, delay_while_idle=delay_while_idle,
+                                         time_to_live=time_to_live, restricted_package_name=restricted_package_name,
+                                         dry_run=dry_run)
+
+        # registration ids are compressed into the task body, other parameters go to the query string.
         task_parameters = {
             'try_count': try_count,
             'api_key': api_key,
-            'registration_ids': registration_ids
+            'message': message_hash,
+        }
+        if package is not None:
+            task_parameters['package'] = package
+        if deferrals:
+            task_parameters['deferrals'] = deferrals
+        task_headers = {
+            'Content-Type': 'application/octet-stream',
+            REGISTRATION_IDS_FORMAT_HEADER: REGISTRATION_IDS_FORMAT_ZLIB_V1,
         }
+
+        return taskqueue.Task(url='/taskqueue/gcm_sender?' + urllib.urlencode(task_parameters),
+                              payload=encode_registration_ids(registration_ids), headers=task_headers,
+                              countdown=try_after, name=task_name)
+
+    @staticmethod
+    def store_message(data=None, collapse_key=None, delay_while_idle=None, time_to_live=None,
+                      restricted_package_name=None, dry_run=False):
+        """
+        Store the message fields by GcmMessageModel. The parameters are the same as GCM.send().
+
+        :return: the message hash, see GcmMessageModel.load().
+        """
+        message = dict()
         if data is not None:
-            task_parameters['data'] = data
+            message['data'] = data
         if collapse_key is not None:
-            task_parameters['collapse_key'] = collapse_key
+            message['collapse_key'] = collapse_key
         if delay_while_idle is not None:
-            task_parameters['delay_while_idle'] = delay_while_idle
+            message['delay_while_idle'] = delay_while_idle
         if time_to_live is not None:
-            task_parameters['time_to_live'] = time_to_live
+            message['time_to_live'] = time_to_live
         if restricted_package_name is not None:
-            task_parameters['restricted_package_name'] = restricted_package_name
+            message['restricted_package_name'] = restricted_package_name
         if dry_run:
-            task_parameters['dry_run'] = dry_run
+            message['dry_run'] = dry_run
+        return gcm_app.GcmMessageModel.store(message)
+
+
+class TaskBatch(object):
+    """
+    Accumulate tasks and add them to a queue in groups of up to 100 tasks with Queue.add_async, instead of one add rpc
+    per task. Call flush() when done, it waits for all add rpcs. Sender tasks pick queue_name by route_queue().
+    """
 
-        taskqueue.add(queue_name=GCM.TASK_QUEUE_NAME, url='/taskqueue/gcm_sender', params=task_parameters,
-                      countdown=try_after)
+    def __init__(self, queue_name):
+        self.queue = taskqueue.Queue(queue_name)
+        self.tasks = list()
+        self.rpcs = list()
+
+    def add(self, task):
+        """
+        :param task: a taskqueue.Task, None is ignored so the result of GCM.build_task() can be added directly.
+        """
+        if task is None:
+            return
+        self.tasks.append(task)
+        if len(self.tasks) >= taskqueue.MAX_TASKS_PER_ADD:
+            self._add_pending_async()
+
+    def flush(self):
+        """
+        Add the remaining tasks and wait for all add rpcs. Named tasks which exist already are skipped, the other tasks
+        of the same group are still added.
+        """
+        self._add_pending_async()
+        for rpc in self.rpcs:
+            try:
+                rpc.get_result()
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError) as e:
+                logging.info('Some tasks were pushed before, skip them: %s' % e)
+        self.rpcs = list()
+
+    def _add_pending_async(self):
+        if self.tasks:
+            self.rpcs.append(self.queue.add_async(self.tasks))
+            self.tasks = list()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+# Copyright 2014 YH Yang <yhuiyang@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+"""Token bucket rate limiting of api requests, shared by all instances through memcache."""
+
+# python import
+import time
+
+# GAE import
+from google.appengine.api import memcache
+
+# local import
+
+
+class RateLimiter(object):
+    """
+    Token bucket which is refilled to capacity every period seconds. Tokens taken by all instances are counted by a
+    memcache counter of the current period. Every instance takes tokens locally and adds them to the memcache counter
+    every flush_count tokens or flush_seconds, so most requests don't need a memcache rpc. The bucket may be
+    overdrawn by the tokens pending in instances, which is fine for protecting capacity.
+
+    If memcache is unavailable, every instance limits with its own tokens only.
+    """
+
+    KEY_TEMPLATE = u'rate-{}-{}-{}'  # keys may be non-ascii, encoded to utf-8
+
+    def __init__(self, name, capacity, period, flush_count=10, flush_seconds=1.0):
+        """
+        :param name: name of the limiter, part of memcache keys.
+        :param capacity: tokens of every key in one period.
+        :param period: seconds between refills.
+        :param flush_count: pending tokens which are added to memcache at once.
+        :param flush_seconds: pending tokens are added to memcache at least this often.
+        """
+        self.name = name
+        self.capacity = capacity
+        self.period = period
+        self.flush_count = flush_count
+        self.flush_seconds = flush_seconds
+        # key -> [period index, tokens taken by all instances as last seen, pending tokens, last flush time]
+        self._buckets = dict()
+
+    def allow(self, key):
+        """
+        Take one token from the bucket of key.
+
+        :param key: what is limited, ex: apk package name.
+        :return: True if the bucket had a token, False if the request should be rejected.
+        """
+        now = time.time()
+        index = int(now // self.period)
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket[0] != index:
+            if len(self._buckets) > 10000:  # keys of old periods
+                self._buckets.clear()
+            bucket = [index, 0, 0, now]
+            self._buckets[key] = bucket
+
+        if bucket[1] + bucket[2] >= self.capacity:
+            return False
+        bucket[2] += 1
+
+        if bucket[2] >= self.flush_count or now - bucket[3] >= self.flush_seconds:
+            taken = self._incr(self.KEY_TEMPLATE.format(self.name, index, key).encode('utf-8'), bucket[2])
+            if taken is not None:
+                bucket[1] = taken
+                bucket[2] = 0
+            bucket[3] = now
+            if taken is not None and taken > self.capacity:
+                return False
+        return True
+
+    def _incr(self, memcache_key, delta):
+        # counters of old periods expire, so they don't push nonces and cached responses out of memcache
+        taken = memcache.incr(memcache_key, delta=delta)
+        if taken is None:
+            if memcache.add(memcache_key, delta, time=self.period * 2):
+                return delta
+            taken = memcache.incr(memcache_key, delta=delta)
+        return taken
+
+    def retry_after(self):
+        """
+        :return: seconds until the buckets are refilled.
+        """
+        return int(self.period - time.time() % self.period) + 1
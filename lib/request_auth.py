@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+# Copyright 2014 YH Yang <yhuiyang@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+
+"""Authentication of api requests sent by clients."""
+
+# python import
+import hashlib
+import hmac
+import random
+import time
+
+# GAE import
+from google.appengine.api import memcache
+
+# local import
+from models import gcm_app
+
+
+# Requests whose timestamp is farther than this from now are rejected.
+TIMESTAMP_WINDOW_SECONDS = 5 * 60
+# Used nonces are remembered as long as their requests are inside the timestamp window.
+NONCE_KEY_TEMPLATE = u'nonce-{}-{}'  # package and nonce may be non-ascii, encoded to utf-8
+NONCE_SECONDS = 2 * TIMESTAMP_WINDOW_SECONDS
+NONCE_LENGTH_MIN = 16
+NONCE_LENGTH_MAX = 64
+
+
+class AuthenticationError(Exception):
+    """
+    The request is rejected, reason is returned to the client and log_message is only logged.
+    """
+    def __init__(self, reason, log_message):
+        super(AuthenticationError, self).__init__(log_message)
+        self.reason = reason
+        self.log_message = log_message
+
+
+def constant_time_equals(a, b):
+    """
+    Compare two strings in time which only depends on their length, so a forged signature can't be guessed byte by
+    byte from response times. hmac.compare_digest() is not available before python 2.7.7.
+    """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def timestamp_to_seconds(timestamp):
+    """
+    Client timestamp is unix time in seconds or in milliseconds.
+
+    :return: unix time in seconds, or None if timestamp is not a number.
+    """
+    try:
+        seconds = float(timestamp)
+    except (TypeError, ValueError):
+        return None
+    if seconds > 100000000000:  # milliseconds
+        seconds /= 1000
+    return seconds
+
+
+class Authenticator(object):
+    """
+    Authenticate one kind of client request signature. Subclasses are registered in AUTHENTICATORS, the first one
+    which accepts the request authenticates it.
+    """
+
+    def accepts(self, request):
+        """
+        :return: True if the request carries the signature of this authenticator.
+        """
+        raise NotImplementedError()
+
+    def authenticate(self, request, package, timestamp):
+        """
+        :param request: webapp2 request.
+        :param package: apk package name the request is for, None if the request isn't for one package.
+        :param timestamp: timestamp parameter of the request.
+        :raise AuthenticationError: if the request is rejected.
+        """
+        raise NotImplementedError()
+
+
+class HmacSha256Authenticator(Authenticator):
+    """
+    X-Signature header is hex-decimal hmac-sha256(client_secret, timestamp + '\\n' + nonce + '\\n' + request body) with
+    the client secret of the app, X-Nonce header is a random string of 16 to 64 characters used only once.
+
+    Cheap checks come first: the timestamp window is checked before the app config is read, and the app config is read
+    from cache, so stale and forged requests are rejected without any datastore rpc. The nonce is taken after the
+    signature matches, so a replayed request is rejected and forged requests don't take nonces.
+    """
+
+    SIGNATURE_HEADER = 'X-Signature'
+    NONCE_HEADER = 'X-Nonce'
+
+    def accepts(self, request):
+        return self.SIGNATURE_HEADER in request.headers
+
+    def authenticate(self, request, package, timestamp):
+        signature = request.headers.get(self.SIGNATURE_HEADER)
+        nonce = request.headers.get(self.NONCE_HEADER)
+        if nonce is None or not (NONCE_LENGTH_MIN <= len(nonce) <= NONCE_LENGTH_MAX):
+            raise AuthenticationError('MissingNonce', 'Client does not send valid nonce.')
+        if package is None:
+            raise AuthenticationError('MissingKey', 'Necessary key missed: package')
+
+        seconds = timestamp_to_seconds(timestamp)
+        if seconds is None or abs(time.time() - seconds) > TIMESTAMP_WINDOW_SECONDS:
+            raise AuthenticationError('TimestampExpired', 'Client timestamp is out of window: %s' % timestamp)
+
+        app = gcm_app.GcmAppModel.get_cached(package)
+        if app is None or not app.client_secret:
+            raise AuthenticationError('UnknownApp', 'Client signs request for unknown app or app without secret.')
+
+        message = u'{}\n{}\n'.format(timestamp, nonce).encode('utf-8') + request.body
+        calculated = hmac.new(app.client_secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+        if not constant_time_equals(signature.lower(), calculated):
+            raise AuthenticationError('HashInvalid', 'Signature is not matched. Client:' + signature)
+
+        # only signed requests take a nonce, so forged requests can't fill memcache
+        if not memcache.add(NONCE_KEY_TEMPLATE.format(package, nonce).encode('utf-8'), 1, time=NONCE_SECONDS):
+            raise AuthenticationError('NonceUsed', 'Client replays nonce: %s' % nonce)
+
+
+class Md5Authenticator(Authenticator):
+    """
+    Legacy X-Hash header, which is md5(md5(timestamp) + request body) in hex-decimal format. It takes no secret, so
+    apps which have a client secret only accept HmacSha256Authenticator.
+    """
+
+    HASH_HEADER = 'X-Hash'
+
+    def accepts(self, request):
+        return True
+
+    def authenticate(self, request, package, timestamp):
+        client_hash = request.headers.get(self.HASH_HEADER)
+        if client_hash is None:
+            raise AuthenticationError('MissingHash', 'Client does not send hash string. User-Agent: ' +
+                                      str(request.user_agent))
+
+        h1 = hashlib.md5()
+        try:
+            h1.update(timestamp)
+        except TypeError:
+            h1.update(str(timestamp))
+        timestamp_hash = h1.digest()  # hash data size = 128bit, 16bytes
+        h2 = hashlib.md5()
+        h2.update(timestamp_hash)
+        h2.update(request.body)
+        calculated_hash = h2.hexdigest()  # represented in hex-decimal format
+
+        if not constant_time_equals(client_hash.lower(), calculated_hash):
+            reasons = ('HashInvalid',) * 30
+            reasons += ('DataCorrupted',) * 17
+            reasons += ('AskAuthor',) * 2
+            reasons += ('AreYouHacker',)
+            raise AuthenticationError(reasons[random.randint(0, len(reasons) - 1)],
+                                      'Hash calculation is not matched. Client:' + client_hash + ', Calculated:' +
+                                      calculated_hash)
+
+        if package is not None:
+            app = gcm_app.GcmAppModel.get_cached(package)
+            if app is not None and app.client_secret:
+                raise AuthenticationError('SignatureRequired', 'App requires X-Signature, X-Hash is not accepted.')
+
+
+AUTHENTICATORS = [HmacSha256Authenticator(), Md5Authenticator()]
+
+
+def authenticate(request, package, timestamp):
+    """
+    Authenticate the request with the first authenticator which accepts it.
+
+    :raise AuthenticationError: if the request is rejected.
+    """
+    for authenticator in AUTHENTICATORS:
+        if authenticator.accepts(request):
+            authenticator.authenticate(request, package, timestamp)
+            return
+    raise AuthenticationError('MissingHash', 'No authenticator accepts the request.')
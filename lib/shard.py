@@ -16,18 +16,49 @@
 """A module implementing a general sharded counter."""
 
 
+import logging
 import random
+import time
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 
 SHARD_KEY_TEMPLATE = 'shard-{}-{:d}'
+WRITES_KEY_TEMPLATE = 'shard-writes-{}'
+COLLISIONS_KEY_TEMPLATE = 'shard-collisions-{}'
+CONFIG_KEY_TEMPLATE = 'shard-config-{}'
+FRESH_KEY_TEMPLATE = 'shard-fresh-{}'
+REFRESH_LOCK_KEY_TEMPLATE = 'shard-refresh-{}'
+
+DEFAULT_NUM_SHARDS = 5
+# Seconds a cached counter total is fresh. A stale total is still served
+# while one request rebuilds it, until it is older than STALE_CACHE_SECONDS.
+TOTAL_CACHE_SECONDS = 60
+STALE_CACHE_SECONDS = 24 * 60 * 60
+# Seconds a request may take to rebuild a total before another one may try.
+REFRESH_LOCK_SECONDS = 10
+
+# Shard configs cached by this instance, name -> (num_shards, expire time).
+# Other instances see a new num_shards after at most CONFIG_CACHE_SECONDS.
+_config_cache = {}
+CONFIG_CACHE_SECONDS = 30
+# A config cached in memcache by a read racing increase_shards() ages out.
+CONFIG_MEMCACHE_SECONDS = 10 * 60
+
+# How many times a shard write is attempted before giving up.
+TRANSACTION_ATTEMPTS = 3
+# A counter gets more shards when more than this ratio of its shard writes
+# collided, given at least SCALE_MIN_WRITES writes were recorded.
+SCALE_COLLISION_RATIO = 0.1
+SCALE_MIN_WRITES = 20
+MAX_SHARDS = 100
 
 
 class GeneralCounterShardConfig(ndb.Model):
     """Tracks the number of shards for each named counter."""
-    num_shards = ndb.IntegerProperty(default=5)
+    num_shards = ndb.IntegerProperty(default=DEFAULT_NUM_SHARDS)
 
     @classmethod
     def all_keys(cls, name):
@@ -40,9 +71,9 @@ class GeneralCounterShardConfig(ndb.Model):
             The full list of ndb.Key values corresponding to all the possible
                 counter shards that could exist.
         """
-        config = cls.get_or_insert(name)
+        num_shards = get_num_shards(name)
         shard_key_strings = [SHARD_KEY_TEMPLATE.format(name, index)
-                             for index in range(config.num_shards)]
+                             for index in range(num_shards)]
         return [ndb.Key(GeneralCounterShard, shard_key_string)
                 for shard_key_string in shard_key_strings]
 
@@ -62,54 +93,173 @@ def get_count(name):
         Integer; the cumulative count of all sharded counters for the given
             counter name.
     """
-    total = memcache.get(name)
-    if total is None:
-        total = 0
-        all_keys = GeneralCounterShardConfig.all_keys(name)
-        for counter in ndb.get_multi(all_keys):
-            if counter is not None:
-                total += counter.count
-        memcache.add(name, total, 60)
-    return total
-
-
-def increment(name):
+    return get_counts([name])[name]
+
+
+def get_counts(names):
+    """Retrieve the values for several sharded counters at once.
+
+    Makes a constant number of RPCs regardless of how many counters are read:
+    cached totals, shard configs and shards are each read with one batch call.
+    Shard configs are read from the datastore, so a rebuilt total includes
+    the shards added by increase_shards().
+
+    When a cached total is stale, only the request holding the refresh lock
+    rebuilds it from the shards, the others serve the stale total meanwhile.
+
+    Args:
+        names: A list of counter names.
+
+    Returns:
+        Dictionary; maps each counter name to its cumulative count.
+    """
+    fresh_prefix = FRESH_KEY_TEMPLATE.format('')
+    fresh_keys = [fresh_prefix + name for name in names]
+    cached = memcache.get_multi(names + fresh_keys)
+    totals = dict((name, cached[name]) for name in names if name in cached)
+    stale_names = [name for name in totals
+                   if fresh_prefix + name not in cached]
+    if stale_names:
+        lock_prefix = REFRESH_LOCK_KEY_TEMPLATE.format('')
+        not_locked = memcache.add_multi(dict.fromkeys(stale_names, 1),
+                                        time=REFRESH_LOCK_SECONDS,
+                                        key_prefix=lock_prefix)
+        # Another request is rebuilding these, serve the stale total.
+        stale_names = [name for name in stale_names if name not in not_locked]
+    missing_names = [name for name in names if name not in totals]
+    missing_names += stale_names
+    if not missing_names:
+        return totals
+
+    num_shards_map = _get_num_shards_multi(missing_names)
+    all_keys = []
+    all_names = []
+    for name in missing_names:
+        for index in range(num_shards_map[name]):
+            all_keys.append(ndb.Key(GeneralCounterShard,
+                                    SHARD_KEY_TEMPLATE.format(name, index)))
+            all_names.append(name)
+    missing_totals = dict.fromkeys(missing_names, 0)
+    for name, counter in zip(all_names, ndb.get_multi(all_keys)):
+        if counter is not None:
+            missing_totals[name] += counter.count
+    memcache.set_multi(missing_totals, time=STALE_CACHE_SECONDS)
+    memcache.set_multi(dict.fromkeys(missing_totals, 1),
+                       time=TOTAL_CACHE_SECONDS, key_prefix=fresh_prefix)
+    if stale_names:
+        memcache.delete_multi(stale_names, key_prefix=lock_prefix)
+
+    totals.update(missing_totals)
+    return totals
+
+
+def increment(name, delta=1):
     """Increment the value for a given sharded counter.
 
     Args:
         name: The name of the counter.
+        delta: How much to increment.
     """
-    config = GeneralCounterShardConfig.get_or_insert(name)
-    _increment(name, config.num_shards)
+    _increment(name, get_num_shards(name), delta=delta)
 
 
-@ndb.transactional
-def _increment(name, num_shards):
-    """Transactional helper to increment the value for a given sharded counter.
+def _increment(name, num_shards, delta=1):
+    """Helper to increment the value for a given sharded counter.
+
+    Every attempt writes a randomly chosen shard in its own transaction.
+    Writes and collisions are recorded in memcache for scale_shards().
+
+    Args:
+        name: The name of the counter.
+        num_shards: How many shards to use.
+        delta: How much to increment.
+    """
+    memcache.incr(WRITES_KEY_TEMPLATE.format(name), initial_value=0)
+    for attempt in range(TRANSACTION_ATTEMPTS):
+        try:
+            _increment_shard(name, num_shards, delta)
+            break
+        except datastore_errors.TransactionFailedError:
+            memcache.incr(COLLISIONS_KEY_TEMPLATE.format(name),
+                          initial_value=0)
+            if attempt == TRANSACTION_ATTEMPTS - 1:
+                raise
+    # Memcache increment does nothing if the name is not a key in memcache
+    memcache.incr(name, delta=delta)
+
+
+@ndb.transactional(retries=0)
+def _increment_shard(name, num_shards, delta):
+    """Transactional helper to increment one shard of a given sharded counter.
 
     Also takes a number of shards to determine which shard will be used.
 
     Args:
         name: The name of the counter.
         num_shards: How many shards to use.
+        delta: How much to increment.
     """
     index = random.randint(0, num_shards - 1)
     shard_key_string = SHARD_KEY_TEMPLATE.format(name, index)
     counter = GeneralCounterShard.get_by_id(shard_key_string)
     if counter is None:
         counter = GeneralCounterShard(id=shard_key_string)
-    counter.count += 1
+    counter.count += delta
     counter.put()
-    # Memcache increment does nothing if the name is not a key in memcache
-    memcache.incr(name)
 
 
-@ndb.transactional
+def scale_shards():
+    """Increase the number of shards for counters whose writes collide often.
+
+    Doubles the shards of a counter when the collision ratio recorded by
+    _increment() since the last run crosses SCALE_COLLISION_RATIO. Run
+    periodically. get_count() sums all shards of the new config, so totals
+    stay correct.
+    """
+    configs = GeneralCounterShardConfig.query().fetch()
+    names = [config.key.string_id() for config in configs]
+    writes_keys = [WRITES_KEY_TEMPLATE.format(name) for name in names]
+    collisions_keys = [COLLISIONS_KEY_TEMPLATE.format(name) for name in names]
+    stats = memcache.get_multi(writes_keys + collisions_keys)
+    for config, writes_key, collisions_key in zip(configs, writes_keys,
+                                                  collisions_keys):
+        name = config.key.string_id()
+        writes = int(stats.get(writes_key) or 0)
+        collisions = int(stats.get(collisions_key) or 0)
+        if writes < SCALE_MIN_WRITES:
+            continue
+        # Start a new observation window.
+        memcache.decr(writes_key, delta=writes)
+        memcache.decr(collisions_key, delta=collisions)
+        if (float(collisions) / writes > SCALE_COLLISION_RATIO and
+                config.num_shards < MAX_SHARDS):
+            num_shards = min(config.num_shards * 2, MAX_SHARDS)
+            logging.info('Counter %s: %d of %d writes collided, increase '
+                         'shards from %d to %d.', name, collisions, writes,
+                         config.num_shards, num_shards)
+            increase_shards(name, num_shards)
+
+
 def increase_shards(name, num_shards):
     """Increase the number of shards for a given sharded counter.
 
     Will never decrease the number of shards.
 
+    Args:
+        name: The name of the counter.
+        num_shards: How many shards to use.
+    """
+    _increase_shards(name, num_shards)
+    # Invalidate after the commit, so the cache is not refilled with the old
+    # config in between.
+    memcache.delete(CONFIG_KEY_TEMPLATE.format(name))
+    _config_cache.pop(name, None)
+
+
+@ndb.transactional
+def _increase_shards(name, num_shards):
+    """Transactional helper of increase_shards().
+
     Args:
         name: The name of the counter.
         num_shards: How many shards to use.
@@ -118,3 +268,49 @@ def increase_shards(name, num_shards):
     if config.num_shards < num_shards:
         config.num_shards = num_shards
         config.put()
+
+
+def _get_num_shards_multi(names):
+    """Retrieve the number of shards for several sharded counters at once.
+
+    Reads the configs from the datastore with one batch call, not from the
+    caches of get_num_shards(): a total rebuilt with an old num_shards would
+    miss the new shards, and be cached for STALE_CACHE_SECONDS. A missing
+    config is not created, the default number of shards is returned for it.
+
+    Args:
+        names: A list of counter names.
+
+    Returns:
+        Dictionary; maps each counter name to its number of shards.
+    """
+    configs = ndb.get_multi([ndb.Key(GeneralCounterShardConfig, name)
+                             for name in names])
+    return dict((name, DEFAULT_NUM_SHARDS if config is None
+                 else config.num_shards)
+                for name, config in zip(names, configs))
+
+
+def get_num_shards(name):
+    """Retrieve the number of shards for a given sharded counter.
+
+    The config is cached in instance memory and memcache, and created with the
+    default number of shards if it doesn't exist.
+
+    Args:
+        name: The name of the counter.
+
+    Returns:
+        Integer; the number of shards.
+    """
+    now = time.time()
+    cached = _config_cache.get(name)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    num_shards = memcache.get(CONFIG_KEY_TEMPLATE.format(name))
+    if num_shards is None:
+        num_shards = GeneralCounterShardConfig.get_or_insert(name).num_shards
+        memcache.add(CONFIG_KEY_TEMPLATE.format(name), num_shards,
+                     time=CONFIG_MEMCACHE_SECONDS)
+    _config_cache[name] = (num_shards, now + CONFIG_CACHE_SECONDS)
+    return num_shards
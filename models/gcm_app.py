@@ -18,13 +18,23 @@
 ##############################################################################
 
 # python import
+import json
+import hashlib
+import time
 
 # GAE import
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 # local import
 
 
+# App configs cached by this instance, apk_package_name -> (entity or None, expire time).
+_app_cache = dict()
+_APP_CACHE_SECONDS = 60
+_APP_CACHE_SIZE = 100  # package names come from clients, unknown ones must not grow the cache without bound
+
+
 class GcmAppModel(ndb.Model):
     """
     All entities have the same parent ndb.Key(GcmAppModel, 'GcmApp')
@@ -33,15 +43,57 @@ class GcmAppModel(ndb.Model):
     display_name = ndb.StringProperty()
     sender_id = ndb.StringProperty(indexed=False)
     google_api_key = ndb.StringProperty(indexed=False)
+    client_secret = ndb.StringProperty(indexed=False)  # key of X-Signature, apps without it accept legacy X-Hash
+    sender_queues = ndb.JsonProperty(indexed=False)  # priority -> queue name, overrides gcm_http.SENDER_QUEUES
+    send_rate_per_minute = ndb.IntegerProperty(indexed=False)  # overrides gcm_http.SendGovernor.RATE_PER_MINUTE
     timestamp = ndb.DateTimeProperty(auto_now=True)
 
+    MEMCACHE_KEY_TEMPLATE = u'gcm-app-{}'  # package names come from clients and may be non-ascii
+    MEMCACHE_SECONDS = 10 * 60  # a config cached by a read racing invalidate() ages out
+
     @classmethod
     def get_instance(cls, apk_package_name):
         return cls.get_by_id(id=apk_package_name, parent=ndb.Key(GcmAppModel, 'GcmApp'))
 
+    @classmethod
+    def get_cached(cls, apk_package_name):
+        """
+        Same as get_instance(), but the app config is cached in instance memory for a short time and in memcache.
+        Unknown apps are cached as well. Call invalidate() after the app config is created or modified. Don't modify
+        the returned entity, it is shared with other requests.
+        """
+        now = time.time()
+        cached = _app_cache.get(apk_package_name)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        memcache_key = cls._memcache_key(apk_package_name)
+        entity = memcache.get(memcache_key)
+        if entity is None:
+            entity = cls.get_instance(apk_package_name)
+            memcache.add(memcache_key, entity if entity is not None else False, time=cls.MEMCACHE_SECONDS)
+        elif entity is False:  # known unknown app
+            entity = None
+        if len(_app_cache) >= _APP_CACHE_SIZE:
+            _app_cache.clear()
+        _app_cache[apk_package_name] = (entity, now + _APP_CACHE_SECONDS)
+        return entity
+
+    @classmethod
+    def invalidate(cls, apk_package_name):
+        """
+        Drop the cached app config. Other instances drop their instance memory copy within a short time.
+        """
+        memcache.delete(cls._memcache_key(apk_package_name))
+        _app_cache.pop(apk_package_name, None)
+
+    @classmethod
+    def _memcache_key(cls, apk_package_name):
+        return cls.MEMCACHE_KEY_TEMPLATE.format(apk_package_name).encode('utf-8')
+
     @classmethod
     def check_exist(cls, apk_package_name):
-        return True if GcmAppModel.get_instance(apk_package_name) else False
+        return True if GcmAppModel.get_cached(apk_package_name) else False
 
 
 class GcmDeviceModel(ndb.Model):
@@ -55,7 +107,10 @@ class GcmDeviceModel(ndb.Model):
     enabled = ndb.BooleanProperty(default=True)
 
     # below are custom properties
-    uuid = ndb.StringProperty(indexed=False)
+    uuid = ndb.StringProperty()  # indexed for the projection query of device listing
+
+    # properties returned by the projection query of device listing
+    LISTING_PROJECTION = ('uuid', 'timestamp')
 
     @classmethod
     def get_instance(cls, registration_id):
@@ -75,8 +130,167 @@ class GcmDeviceModel(ndb.Model):
             entity.enabled = True
             entity.put()
 
+    @classmethod
+    def query_devices(cls, package, enabled_only=True):
+        q = cls.query(cls.package == package)
+        if enabled_only:
+            q = q.filter(cls.enabled == True)
+        return q
+
+    @classmethod
+    def iter_registration_ids(cls, package, enabled_only=True, batch_size=1000):
+        """
+        Iterate registration ids of devices for the given app with a keys-only query, no entity is read.
+        """
+        q = cls.query_devices(package, enabled_only=enabled_only).order(cls.key)
+        for key in q.iter(keys_only=True, batch_size=batch_size):
+            yield key.string_id()
+
+    @classmethod
+    def fetch_registration_ids_page(cls, package, page_size, start_cursor=None, enabled_only=True):
+        """
+        Fetch one page of registration ids with a keys-only query. Devices are in key order, which does not change
+        while devices are updated, so the returned cursor is safe to resume from later.
+
+        :return: (registration ids, cursor, more) tuple, same as ndb.Query.fetch_page()
+        """
+        q = cls.query_devices(package, enabled_only=enabled_only).order(cls.key)
+        keys, cursor, more = q.fetch_page(page_size, start_cursor=start_cursor, keys_only=True, batch_size=page_size)
+        return [key.string_id() for key in keys], cursor, more
+
+    @classmethod
+    def iter_device_listing(cls, package, limit, enabled_only=True):
+        """
+        Iterate most recently updated devices for the given app with a projection query. Only properties in
+        LISTING_PROJECTION are populated on the returned entities.
+        Devices written before uuid was indexed have no index rows, and are missing until the device migration (see
+        TaskQueueDeviceMigration) re-puts them.
+        """
+        q = cls.query_devices(package, enabled_only=enabled_only).order(-cls.timestamp)
+        return q.iter(limit=limit, projection=cls.LISTING_PROJECTION, batch_size=limit)
+
+
+class GcmDeviceMigrationModel(ndb.Model):
+    """
+    GcmDeviceModel without auto_now timestamp, used by TaskQueueDeviceMigration to re-put devices keeping their
+    timestamp. It maps to the same kind but is not registered for it, so devices read by key or query are still
+    GcmDeviceModel entities.
+    """
+    package = ndb.StringProperty()
+    version = ndb.IntegerProperty()
+    timestamp = ndb.DateTimeProperty()
+    enabled = ndb.BooleanProperty(default=True)
+    uuid = ndb.StringProperty()
+
+    @classmethod
+    def _get_kind(cls):
+        return GcmDeviceModel._get_kind()
+
+    @classmethod
+    def _update_kind_map(cls):
+        # keep GcmDeviceModel as the model class of the kind
+        pass
+
+    @classmethod
+    def from_device(cls, device):
+        return cls(key=device.key, package=device.package, version=device.version, timestamp=device.timestamp,
+                   enabled=device.enabled, uuid=device.uuid)
+
 
 class GcmDeviceDailyCountModel(ndb.Model):
     # Entity key = ndb.Key(GcmDeviceDailyCountModel, 'app.package.name_{register,unregister}_yyyy-mm-dd')
     count = ndb.IntegerProperty(default=0)  # count for this one day
     countTillYesterday = ndb.IntegerProperty(default=0)  # count from long time ago to yesterday
+
+
+class GcmBroadcastJobModel(ndb.Model):
+    """
+    A message sent to all devices of one app. The fan-out tasks walk through the devices segment by segment, and
+    checkpoint the query cursor of the next segment here, so a failed segment resumes from its own cursor.
+    Entity's key = ndb.Key(GcmBroadcastJobModel, <auto allocated id>)
+    """
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_ABORTED = 'aborted'
+
+    package = ndb.StringProperty()
+    status = ndb.StringProperty(choices=(STATUS_RUNNING, STATUS_DONE, STATUS_ABORTED), default=STATUS_RUNNING)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    timestamp = ndb.DateTimeProperty(auto_now=True)
+
+    # message to send
+    collapse_key = ndb.StringProperty(indexed=False)
+    data = ndb.JsonProperty()
+    delay_while_idle = ndb.BooleanProperty(indexed=False)
+    time_to_live = ndb.IntegerProperty(indexed=False)
+    dry_run = ndb.BooleanProperty(indexed=False, default=False)
+
+    # fan-out progress
+    segment = ndb.IntegerProperty(indexed=False, default=0)  # next segment to run
+    cursor = ndb.StringProperty(indexed=False)  # urlsafe cursor where the next segment starts
+    device_count = ndb.IntegerProperty(indexed=False, default=0)
+
+
+# Messages loaded by this instance, keyed by message hash. Messages are immutable, so entries never go stale.
+_message_cache = dict()
+_MESSAGE_CACHE_SIZE = 100
+
+
+class GcmMessageModel(ndb.Model):
+    """
+    A message (data, collapse_key, time_to_live, ...) sent by sender tasks. It is stored once under the hash of its
+    content, and tasks only carry the hash.
+    Entity's key = ndb.Key(GcmMessageModel, sha1 hex digest of the message json)
+    """
+    message = ndb.JsonProperty(compressed=True)
+    timestamp = ndb.DateTimeProperty(auto_now_add=True)
+
+    MEMCACHE_KEY_TEMPLATE = 'message-{}'
+
+    @classmethod
+    def store(cls, message):
+        """
+        Store the message if it is not stored yet.
+
+        :param message: a dict of the message fields.
+        :return: the message hash, used to load the message later.
+        """
+        message_json = json.dumps(message, sort_keys=True, separators=(',', ':'))
+        message_hash = hashlib.sha1(message_json).hexdigest()
+        if message_hash in _message_cache:
+            return message_hash
+
+        memcache_key = cls.MEMCACHE_KEY_TEMPLATE.format(message_hash)
+        if memcache.get(memcache_key) is None:
+            cls(id=message_hash, message=message).put()
+            memcache.set(memcache_key, message)
+        cls._cache_locally(message_hash, message)
+        return message_hash
+
+    @classmethod
+    def load(cls, message_hash):
+        """
+        Load a stored message from instance memory, memcache or data store, whichever has it first.
+
+        :return: a dict of the message fields, or None if the message does not exist.
+        """
+        message = _message_cache.get(message_hash)
+        if message is not None:
+            return message
+
+        memcache_key = cls.MEMCACHE_KEY_TEMPLATE.format(message_hash)
+        message = memcache.get(memcache_key)
+        if message is None:
+            entity = cls.get_by_id(message_hash)
+            if entity is None:
+                return None
+            message = entity.message
+            memcache.add(memcache_key, message)
+        cls._cache_locally(message_hash, message)
+        return message
+
+    @staticmethod
+    def _cache_locally(message_hash, message):
+        if len(_message_cache) >= _MESSAGE_CACHE_SIZE:
+            _message_cache.clear()
+        _message_cache[message_hash] = message
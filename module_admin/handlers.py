@@ -18,8 +18,10 @@
 ##############################################################################
 
 # python import
+import binascii
 import logging
 import json
+import os
 from datetime import date, timedelta
 
 # GAE import
@@ -31,6 +33,7 @@ from lib.base_handler import BaseHandler
 from models import gcm_app
 from lib import gviz_api
 from lib import shard
+from lib import broadcast
 from lib import gcm_http
 from lib import parameter_helper
 
@@ -108,6 +111,7 @@ class GcmDashboardHandler(BaseHandler):
             entity = gcm_app.GcmAppModel(id=package, parent=parent_key)
             entity.populate(display_name=name, sender_id=sender, google_api_key=key)
             entity.put()
+            gcm_app.GcmAppModel.invalidate(package)
             self.response.set_cookie('alert-success', u'成功創建GCM app: ' + name, max_age=30)
 
         self.redirect_to('admin-dashboard')
@@ -136,13 +140,15 @@ class GcmDevicesCRUDHandler(BaseHandler):
         # retrieve app configuration from given key
         try:
             given_key = ndb.Key(urlsafe=urlsafe_key)
-            given_entity = given_key.get()
+            given_entity = gcm_app.GcmAppModel.get_cached(given_key.string_id())
         except ProtocolBufferDecodeError:
             given_entity = None
         if given_entity is not None:
             params['package_name'] = given_key.id()
             params['sender_id'] = given_entity.sender_id
             params['api_key'] = given_entity.google_api_key
+            params['client_secret'] = given_entity.client_secret
+            params['secret_url'] = self.uri_for('admin-app-secret', urlsafe_key=urlsafe_key)
 
         # check if alert messages exist (only one most recently for each alert type)
         for alert in ('danger', 'warning', 'info', 'success'):
@@ -162,24 +168,24 @@ class GcmDevicesCRUDHandler(BaseHandler):
             params['gcm_app_list'].append(d)
 
         # query gcm device list for this app
-        devices = gcm_app.GcmDeviceModel.query(gcm_app.GcmDeviceModel.package == params['package_name'])
-        devices = devices.order(-gcm_app.GcmDeviceModel.timestamp)
-        devices = devices.fetch(100)
+        devices = gcm_app.GcmDeviceModel.iter_device_listing(params['package_name'], 100)
         l = list()
         for device in devices:
             d = dict()
             d['uuid'] = device.uuid
-            d['package'] = device.package
-            d['version'] = device.version
+            d['package'] = params['package_name']
             d['timestamp'] = device.timestamp
             d['registration_id'] = device.key.id()
             l.append(d)
         params['devices'] = l
 
         # device count for registered and unregistered
+        register_name = given_key.string_id() + '_register'
+        unregister_name = given_key.string_id() + '_unregister'
+        counts = shard.get_counts([register_name, unregister_name])
         params['device_count'] = dict()
-        params['device_count']['registered'] = shard.get_count(given_key.string_id() + '_register')
-        params['device_count']['unregistered'] = shard.get_count(given_key.string_id() + '_unregister')
+        params['device_count']['registered'] = counts[register_name]
+        params['device_count']['unregistered'] = counts[unregister_name]
 
         self.render_template('gcm_devices.html', **params)
 
@@ -201,6 +207,9 @@ class GcmDevicesCRUDHandler(BaseHandler):
         time_to_live = None if len(time_to_live) == 0 else int(time_to_live)
         data = self.request.POST.get('data')
         dry_run = parameter_helper.to_bool(self.request.POST.get('dry_run'), default=False)
+        # send to the given devices only, or broadcast to all devices if empty
+        registration_ids = [line.strip() for line in self.request.POST.get('registration_ids', '').splitlines()
+                            if line.strip()]
 
         data_valid = True
         data_dict = None
@@ -221,40 +230,23 @@ class GcmDevicesCRUDHandler(BaseHandler):
         if data_valid:
             try:
                 app_key = ndb.Key(urlsafe=urlsafe_key)
-                app_entity = app_key.get()
+                app_entity = gcm_app.GcmAppModel.get_cached(app_key.string_id())
             except ProtocolBufferDecodeError:
                 app_entity = None
 
-            batch_size = 50
-            if app_entity is not None:
-                api_key = app_entity.google_api_key
-                q = gcm_app.GcmDeviceModel.query(gcm_app.GcmDeviceModel.package == app_entity.key.string_id())
-                q = q.order(-gcm_app.GcmDeviceModel.timestamp)
-                devices, cursor, more = q.fetch_page(batch_size)
-                device_count = len(devices)
-                d = list()
-                for device in devices:
-                    d.append(device.key.string_id())
-                if device_count:
-                    gcm_http.GCM.push_to_task_queue(api_key, d, 0, suggested_try_after=None, data=data_dict,
-                                                    collapse_key=collapse_key, delay_while_idle=delay_while_idle,
-                                                    time_to_live=time_to_live, restricted_package_name=None,
-                                                    dry_run=dry_run)
-
-                while more:
-                    devices, cursor, more = q.fetch_page(batch_size, start_cursor=cursor)
-                    device_count += len(devices)
-                    d = list()
-                    for device in devices:
-                        d.append(device.key.string_id())
-
-                    gcm_http.GCM.push_to_task_queue(api_key, d, 0, suggested_try_after=None, data=data_dict,
-                                                    collapse_key=collapse_key, delay_while_idle=delay_while_idle,
-                                                    time_to_live=time_to_live, restricted_package_name=None,
-                                                    dry_run=dry_run)
-
+            if app_entity is not None and registration_ids:
+                gcm_http.GCM.push_to_task_queue(app_entity.google_api_key, registration_ids, 0,
+                                                collapse_key=collapse_key, data=data_dict,
+                                                delay_while_idle=delay_while_idle, time_to_live=time_to_live,
+                                                dry_run=dry_run, package=app_entity.key.string_id())
+                alert_type = 'success'
+                alert_message = u'即將在背景透過 Google GCM Server 傳送訊息至 %d 個 GCM 客戶端' % len(registration_ids)
+            elif app_entity is not None:
+                job = broadcast.start(app_entity.key.string_id(), collapse_key=collapse_key, data=data_dict,
+                                      delay_while_idle=delay_while_idle, time_to_live=time_to_live, dry_run=dry_run)
+                logging.info('Broadcast job %d started.' % job.key.id())
                 alert_type = 'success'
-                alert_message = u'即將透過 Google GCM Server 傳送訊息至 ' + str(device_count) + u' 個 GCM 客戶端'
+                alert_message = u'已建立推播工作，即將在背景透過 Google GCM Server 傳送訊息至所有 GCM 客戶端'
             else:
                 alert_type = 'danger'
                 alert_message = u'錯誤的gcm app(網址錯誤?)'
@@ -268,3 +260,35 @@ class GcmDevicesCRUDHandler(BaseHandler):
         if alert_type not in ('success', 'info', 'warning', 'danger'):
             return
         self.response.set_cookie('alert-' + alert_type, message, max_age=max_age)
+
+
+class GcmAppSecretHandler(BaseHandler):
+    def post(self, urlsafe_key):
+        """
+        Generate or rotate the client secret of the app, or remove it. Clients of an app with client secret need to
+        sign requests with X-Signature, the legacy X-Hash is accepted again after the secret is removed.
+        """
+
+        action = self.request.POST.get('action')
+        try:
+            app_key = ndb.Key(urlsafe=urlsafe_key)
+            app_entity = app_key.get()
+        except ProtocolBufferDecodeError:
+            app_entity = None
+
+        if app_entity is None:
+            self.response.set_cookie('alert-danger', u'錯誤的gcm app(網址錯誤?)', max_age=30)
+        elif action == 'rotate':
+            app_entity.client_secret = binascii.hexlify(os.urandom(32))
+            app_entity.put()
+            gcm_app.GcmAppModel.invalidate(app_key.string_id())
+            self.response.set_cookie('alert-success', u'已產生新的 Client Secret，舊的 Client Secret 已失效', max_age=30)
+        elif action == 'remove':
+            app_entity.client_secret = None
+            app_entity.put()
+            gcm_app.GcmAppModel.invalidate(app_key.string_id())
+            self.response.set_cookie('alert-warning', u'已移除 Client Secret，客戶端可再使用 X-Hash', max_age=30)
+        else:
+            self.response.set_cookie('alert-danger', u'未知的操作: ' + unicode(action), max_age=30)
+
+        self.redirect_to('admin-devices-crud', urlsafe_key=urlsafe_key)
@@ -26,12 +26,15 @@ from webapp2_extras.routes import RedirectRoute
 # local import
 from handlers import GcmDashboardHandler
 from handlers import GcmDevicesCRUDHandler
+from handlers import GcmAppSecretHandler
 
 _routes = [
     RedirectRoute(r'/admin/', redirect_to_name='admin-dashboard', name='admin-base', strict_slash=True),
     RedirectRoute(r'/admin/dashboard', handler=GcmDashboardHandler, name='admin-dashboard', strict_slash=True),
     RedirectRoute(r'/admin/app/<urlsafe_key>', handler=GcmDevicesCRUDHandler, name='admin-devices-crud',
                   strict_slash=True),
+    RedirectRoute(r'/admin/app/<urlsafe_key>/secret', handler=GcmAppSecretHandler, name='admin-app-secret',
+                  strict_slash=True),
 ]
 
 
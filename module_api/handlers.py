@@ -21,73 +21,144 @@
 # python import
 import logging
 import json
-import hashlib
-import random
 
 # GAE import
 import webapp2
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from google.appengine.ext import db
 
 # local import
 from models import gcm_app
-from lib import shard
+from lib import rate_limit
+from lib import request_auth
 
 
-class RegisterHandlerV1(webapp2.RequestHandler):
+# Counter updates of single registrations are applied by TaskQueueCounterIncrement in taskqueue module.
+COUNTER_TASK_QUEUE_NAME = 'gcm-counter'
+COUNTER_TASK_URL = '/taskqueue/counter_increment'
 
-    def post(self):
 
-        # check header 'Content-Type' and read necessary parameters
+class ApiHandlerV1(webapp2.RequestHandler):
+    """
+    Common parameter parsing, client verification and result writing of api v1 handlers.
+    """
+
+    def read_parameters(self, required, optional=()):
+        """
+        Read parameters from json body or from form, depending on the 'Content-Type' header.
+
+        :param required: names of the required parameters.
+        :param optional: names of the optional parameters, missing ones are None.
+        :return: a dict of parameters, or None if parameters are invalid, in which case the result is set already.
+        """
         if self.request.content_type == 'application/json':
             try:
                 content = json.loads(self.request.body)
-                uuid = content['uuid']
-                timestamp = content['timestamp']
-                registration_id = content['registration_id']
-                package = content['package']
-                version = content['version']
-            except KeyError as ke:
-                self.set_result('Fail', 'MissingKey', 'Necessary key missed: ' + str(ke))
-                return
+                if not isinstance(content, dict):
+                    raise ValueError('Expect json object.')
             except ValueError as ve:
                 self.set_result('Fail', 'BadJsonFormat', 'Client send bad json format: ' + str(ve))
-                return
+                return None
         else:
-            try:
-                uuid = self.request.POST['uuid']
-                timestamp = self.request.POST['timestamp']
-                registration_id = self.request.POST['registration_id']
-                package = self.request.POST['package']
-                version = self.request.POST['version']
-            except KeyError as ke:
-                self.set_result('Fail', 'MissingKey', 'Necessary key missed: ' + str(ke))
-                return
+            content = self.request.POST
 
-        # verify client information
-        client_hash = self.request.headers.get('X-Hash')
-        if client_hash is None:
-            self.set_result('Fail', 'MissingHash', 'Client does not send hash string. User-Agent: ' + self.request.user_agent)
-            return
+        try:
+            parameters = dict((name, content[name]) for name in required)
+        except KeyError as ke:
+            self.set_result('Fail', 'MissingKey', 'Necessary key missed: ' + str(ke))
+            return None
+        for name in optional:
+            parameters[name] = content.get(name)
+        return parameters
+
+    def authenticate(self, timestamp, package):
+        """
+        Authenticate the request by lib.request_auth, either by X-Signature with the client secret of the app, or by
+        the legacy X-Hash.
 
-        h1 = hashlib.md5()
+        :param package: apk package name the request is for, None if the request isn't for one package.
+        :return: True if the request is authenticated, otherwise False and the result is set already.
+        """
         try:
-            h1.update(timestamp)
-        except TypeError:
-            h1.update(str(timestamp))
-        timestamp_hash = h1.digest()  # hash data size = 128bit, 16bytes
-        h2 = hashlib.md5()
-        h2.update(timestamp_hash)
-        h2.update(self.request.body)
-        calculated_hash = h2.hexdigest()  # represented in hex-decimal format
-
-        if client_hash.lower() != calculated_hash.lower():
-            reasons = ('HashInvalid',) * 30
-            reasons += ('DataCorrupted',) * 17
-            reasons += ('AskAuthor',) * 2
-            reasons += ('AreYouHacker',)
-            self.set_result('Fail', reasons[random.randint(0, len(reasons) - 1)],
-                            'Hash calculation is not matched. Client:'+client_hash+', Calculated:'+calculated_hash)
+            request_auth.authenticate(self.request, package, timestamp)
+        except request_auth.AuthenticationError as ae:
+            self.set_result('Fail', ae.reason, ae.log_message)
+            return False
+        return True
+
+    def set_result(self, result, reason=None, log_message=None, **extra):
+        response = dict()
+        response['result'] = result
+        if reason is not None:
+            response['reason'] = reason
+        response.update(extra)
+        if log_message is not None:
+            logging.debug(log_message)
+        self.write_response(response)
+
+    def write_response(self, response):
+        self.result = response
+        self.response.status = '200 OK'
+        self.response.write(json.dumps(response))
+
+
+class RegisterHandlerV1(ApiHandlerV1):
+
+    DEDUP_KEY_TEMPLATE = u'register-{}-{}'  # registration id may be non-ascii, encoded to utf-8
+    DEDUP_SECONDS = 5 * 60
+    # reasons which a retry of the same request would get again, RetryLater and hash failures are not replayed.
+    DEDUP_REASONS = (None, 'AlreadyRegistered', 'UnknownApp')
+
+    # a misbehaving app build is throttled before authentication and any datastore access
+    package_limiter = rate_limit.RateLimiter('register-package', capacity=500, period=10)
+    client_limiter = rate_limit.RateLimiter('register-client', capacity=10, period=60, flush_count=1)
+
+    def post(self):
+
+        # read necessary parameters
+        parameters = self.read_parameters(('uuid', 'timestamp', 'registration_id', 'package', 'version'))
+        if parameters is None:
+            return
+
+        # rate limit by app and by client
+        package = parameters['package']
+        for limiter, key in ((self.package_limiter, package),
+                             (self.client_limiter, u'{}-{}'.format(package, parameters['uuid']))):
+            if not limiter.allow(key):
+                self.set_result('Fail', 'RetryLater', 'Client register too often: ' + key,
+                                retry_after=limiter.retry_after())
+                return
+
+        # replay the response of the same request, clients retry aggressively on flaky networks. X-Signature and
+        # X-Hash cover the timestamp and the whole body, so only identical requests share the key.
+        client_hash = self.request.headers.get('X-Signature') or self.request.headers.get('X-Hash')
+        dedup_key = None
+        if client_hash is not None:
+            dedup_key = self.DEDUP_KEY_TEMPLATE.format(parameters['registration_id'],
+                                                       client_hash.lower()).encode('utf-8')
+            response = memcache.get(dedup_key)
+            if response is not None:
+                logging.debug('Replay response of a repeated register request.')
+                self.write_response(response)
+                return
+
+        self.result = None
+        self.register(parameters)
+
+        if dedup_key is not None and self.result is not None and self.result.get('reason') in self.DEDUP_REASONS:
+            memcache.set(dedup_key, self.result, time=self.DEDUP_SECONDS)
+
+    def register(self, parameters):
+        uuid = parameters['uuid']
+        timestamp = parameters['timestamp']
+        registration_id = parameters['registration_id']
+        package = parameters['package']
+        version = parameters['version']
+
+        # verify client information
+        if not self.authenticate(timestamp, package):
             return
 
         # check gcm app exist
@@ -112,34 +183,265 @@ class RegisterHandlerV1(webapp2.RequestHandler):
 
         # save into data store
         try:
-            self.register_device(registration_id, package, int(version), uuid, enable_only=enable_only)
+            registered = self.register_device(registration_id, package, int(version), uuid, enable_only=enable_only)
         except db.TransactionFailedError:
-            self.set_result('Fail', 'RetryLater', 'Cross group transaction db write failed.')
+            self.set_result('Fail', 'RetryLater', 'Transaction db write failed.')
+            return
+        if not registered:
+            self.set_result('Fail', 'AlreadyRegistered', 'Client registered by a concurrent request.')
             return
 
         self.set_result('OK')
 
-    @ndb.transactional(xg=True, retries=0)
-    def register_device(self, registration_id, package, version, uuid, enable_only=False):
-        # create a registered device entity
-        entity = gcm_app.GcmDeviceModel(id=registration_id)
+    @staticmethod
+    @ndb.transactional
+    def register_device(registration_id, package, version, uuid, enable_only=False):
+        """
+        Create or re-enable the device entity. The transaction only spans the device entity group, the registered
+        device count is increased by a transactional task, which is enqueued if and only if the device is written.
+
+        :return: True if the device is registered, False if it was registered by a concurrent request.
+        """
         if enable_only:
+            # keep package, version and uuid of the registered device
+            entity = gcm_app.GcmDeviceModel.get_instance(registration_id)
+            if entity is None or entity.enabled:
+                return False
             entity.enabled = True
         else:
+            if gcm_app.GcmDeviceModel.get_instance(registration_id) is not None:
+                return False
+            # create a registered device entity
+            entity = gcm_app.GcmDeviceModel(id=registration_id)
             entity.package = package
             entity.version = version
             entity.uuid = uuid
         entity.put()
 
         # increase registered device count for this app package
-        shard.increment(package + '_register')
+        taskqueue.add(queue_name=COUNTER_TASK_QUEUE_NAME, url=COUNTER_TASK_URL,
+                      params={'name': entity.package + '_register'}, transactional=True)
+        return True
 
-    def set_result(self, result, reason=None, log_message=None):
-        response = dict()
-        response['result'] = result
-        if reason is not None:
-            response['reason'] = reason
-        if log_message is not None:
-            logging.debug(log_message)
-        self.response.status = '200 OK'
-        self.response.write(json.dumps(response))
+
+class UnregisterHandlerV1(ApiHandlerV1):
+
+    MAX_DEVICES = 500  # devices in one request
+
+    def post(self):
+        """
+        Disable registered devices, so no more message is sent to them.
+
+        Parameters: timestamp, package, and either registration_id for one device, or registration_ids (json array,
+        json body only) for up to 500 devices. The request is authenticated the same way as register.
+
+        Result of single device: 'OK', or 'Fail' with reason 'NotRegistered', 'AlreadyUnregistered' or 'RetryLater'.
+        Result of several devices: 'OK' with 'results', a json object mapping every registration id to 'OK',
+        'NotRegistered', 'AlreadyUnregistered' or 'RetryLater'.
+        """
+
+        # read necessary parameters
+        parameters = self.read_parameters(('timestamp', 'package'), optional=('registration_id', 'registration_ids'))
+        if parameters is None:
+            return
+        timestamp = parameters['timestamp']
+        package = parameters['package']
+        if parameters['registration_ids'] is not None:
+            registration_ids = parameters['registration_ids']
+            if not isinstance(registration_ids, list) or not (1 <= len(registration_ids) <= self.MAX_DEVICES):
+                self.set_result('Fail', 'BadJsonFormat', 'registration_ids needs to be json array of 1 to %d '
+                                'registration ids.' % self.MAX_DEVICES)
+                return
+            bulk = True
+        elif parameters['registration_id'] is not None:
+            registration_ids = [parameters['registration_id']]
+            bulk = False
+        else:
+            self.set_result('Fail', 'MissingKey', 'Necessary key missed: registration_id')
+            return
+        for registration_id in registration_ids:
+            if not isinstance(registration_id, str) and not isinstance(registration_id, unicode):
+                self.set_result('Fail', 'BadJsonFormat', 'registration id needs to be string.')
+                return
+
+        # verify client information
+        if not self.authenticate(timestamp, package):
+            return
+
+        # check gcm app exist
+        if not gcm_app.GcmAppModel.check_exist(package):
+            self.set_result('Fail', 'UnknownApp', 'Client unregister for unknown app.')
+            return
+
+        # disable devices of this app which are still enabled, every device in its own transaction and all
+        # transactions run concurrently. A device unregistered by a concurrent request is counted once.
+        futures = dict()
+        for registration_id in registration_ids:
+            if registration_id not in futures:
+                futures[registration_id] = self.unregister_device_async(registration_id, package)
+        results = dict()
+        for registration_id, future in futures.items():
+            try:
+                results[registration_id] = future.get_result()
+            except db.TransactionFailedError:
+                results[registration_id] = 'RetryLater'
+
+        if bulk:
+            self.set_result('OK', results=results)
+        elif results[registration_ids[0]] == 'OK':
+            self.set_result('OK')
+        else:
+            self.set_result('Fail', results[registration_ids[0]], 'Client unregister a device which is not enabled.')
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def unregister_device_async(registration_id, package):
+        """
+        :return: a future of 'OK' if the device is disabled, or 'NotRegistered' or 'AlreadyUnregistered'.
+        """
+        entity = yield gcm_app.GcmDeviceModel.get_by_id_async(registration_id)
+        if entity is None or entity.package != package:
+            raise ndb.Return('NotRegistered')
+        if not entity.enabled:
+            raise ndb.Return('AlreadyUnregistered')
+        entity.enabled = False
+        yield entity.put_async()
+
+        # increase unregistered device count for this app package, enqueued if and only if the device is written
+        yield taskqueue.Queue(COUNTER_TASK_QUEUE_NAME).add_async(
+            taskqueue.Task(url=COUNTER_TASK_URL, params={'name': package + '_unregister'}), transactional=True)
+        raise ndb.Return('OK')
+
+
+class RegisterBatchHandlerV1(ApiHandlerV1):
+
+    MAX_DEVICES = 500  # devices in one request
+
+    def post(self):
+        """
+        Register many devices in one request, for SDK clients which queue registrations and for server-side imports.
+
+        The request body is a json object: {"timestamp": ..., "package": ..., "devices": [{"uuid": ...,
+        "registration_id": ..., "package": ..., "version": ...}, ...]}. The request is authenticated the same way as
+        register for the top-level package, over the whole body. Devices of another package fail with
+        'PackageMismatch'.
+
+        Result is 'OK' with 'results', a json array holding the result of every device in request order, ex:
+        {"registration_id": ..., "result": "Fail", "reason": "AlreadyRegistered"}
+        """
+
+        # read necessary parameters
+        if self.request.content_type != 'application/json':
+            self.set_result('Fail', 'BadJsonFormat', 'Batch register only accepts json body.')
+            return
+        parameters = self.read_parameters(('timestamp', 'package', 'devices'))
+        if parameters is None:
+            return
+        timestamp = parameters['timestamp']
+        devices = parameters['devices']
+        package = parameters['package']
+        if not isinstance(devices, list) or not (1 <= len(devices) <= self.MAX_DEVICES):
+            self.set_result('Fail', 'BadJsonFormat', 'devices needs to be json array of 1 to %d devices.' %
+                            self.MAX_DEVICES)
+            return
+
+        # verify client information
+        if not self.authenticate(timestamp, package):
+            return
+
+        # validate every device, invalid ones only fail themselves
+        results = list()
+        valid_devices = list()
+        for device in devices:
+            try:
+                registration_id = device['registration_id']
+                for value in (registration_id, device['package'], device['uuid']):
+                    if not isinstance(value, str) and not isinstance(value, unicode):
+                        raise TypeError('registration_id, package and uuid need to be string.')
+                valid_devices.append((len(results), registration_id, device['package'], int(device['version']),
+                                      device['uuid']))
+                results.append({'registration_id': registration_id})
+            except (KeyError, TypeError, ValueError) as e:
+                registration_id = device.get('registration_id') if isinstance(device, dict) else None
+                if not isinstance(registration_id, str) and not isinstance(registration_id, unicode):
+                    registration_id = None
+                results.append({'registration_id': registration_id, 'result': 'Fail', 'reason': 'MissingKey'})
+                logging.debug('Invalid device %s: %s' % (device, e))
+
+        # the request is authenticated for one app only
+        devices_of_package = list()
+        for device in valid_devices:
+            if device[2] == package:
+                devices_of_package.append(device)
+            else:
+                results[device[0]].update(result='Fail', reason='PackageMismatch')
+        valid_devices = devices_of_package
+
+        # check gcm app exist
+        if valid_devices and not gcm_app.GcmAppModel.check_exist(package):
+            for device in valid_devices:
+                results[device[0]].update(result='Fail', reason='UnknownApp')
+            valid_devices = list()
+
+        # devices which are registered already are decided by one batch get, without opening a transaction
+        unique_devices = list()
+        seen_registration_ids = set()
+        for device in valid_devices:
+            if device[1] in seen_registration_ids:
+                results[device[0]].update(result='Fail', reason='AlreadyRegistered')
+                continue
+            seen_registration_ids.add(device[1])
+            unique_devices.append(device)
+        entities = ndb.get_multi([ndb.Key(gcm_app.GcmDeviceModel, device[1]) for device in unique_devices])
+
+        # register every other device in its own transaction, all transactions run concurrently. A device registered
+        # by a concurrent request fails in its transaction with AlreadyRegistered, so it is counted once.
+        futures = list()
+        for (index, registration_id, _, version, uuid), entity in zip(unique_devices, entities):
+            if entity is not None and entity.package != package:
+                results[index].update(result='Fail', reason='PackageMismatch')
+            elif entity is not None and entity.enabled:
+                results[index].update(result='Fail', reason='AlreadyRegistered')
+            else:
+                futures.append((index, self.register_device_async(registration_id, package, version, uuid)))
+
+        for index, future in futures:
+            try:
+                result = future.get_result()
+            except db.TransactionFailedError:
+                results[index].update(result='Fail', reason='RetryLater')
+                continue
+            if result == 'OK':
+                results[index]['result'] = 'OK'
+            else:
+                results[index].update(result='Fail', reason=result)
+
+        self.set_result('OK', results=results)
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def register_device_async(registration_id, package, version, uuid):
+        """
+        Same as RegisterHandlerV1.register_device(), but a device of another package is not re-enabled.
+
+        :return: a future of 'OK' if the device is registered, or 'AlreadyRegistered' or 'PackageMismatch'.
+        """
+        entity = yield gcm_app.GcmDeviceModel.get_by_id_async(registration_id)
+        if entity is not None and entity.package != package:
+            raise ndb.Return('PackageMismatch')
+        if entity is not None and entity.enabled:
+            raise ndb.Return('AlreadyRegistered')
+        if entity is not None:
+            # registered and unregistered before, re-enable it again.
+            entity.enabled = True
+        else:
+            entity = gcm_app.GcmDeviceModel(id=registration_id)
+            entity.package = package
+            entity.version = version
+            entity.uuid = uuid
+        yield entity.put_async()
+
+        # increase registered device count for this app package, enqueued if and only if the device is written
+        yield taskqueue.Queue(COUNTER_TASK_QUEUE_NAME).add_async(
+            taskqueue.Task(url=COUNTER_TASK_URL, params={'name': package + '_register'}), transactional=True)
+        raise ndb.Return('OK')
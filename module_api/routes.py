@@ -28,6 +28,10 @@ import handlers
 
 _routes = [
     RedirectRoute('/api/v1/register', handler=handlers.RegisterHandlerV1, name='api-register-v1', strict_slash=True),
+    RedirectRoute('/api/v1/register_batch', handler=handlers.RegisterBatchHandlerV1, name='api-register-batch-v1',
+                  strict_slash=True),
+    RedirectRoute('/api/v1/unregister', handler=handlers.UnregisterHandlerV1, name='api-unregister-v1',
+                  strict_slash=True),
 ]
 
 
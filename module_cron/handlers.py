@@ -23,6 +23,7 @@ from datetime import date, timedelta
 
 # GAE import
 import webapp2
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 # local import
@@ -37,13 +38,18 @@ class CronDaily0001Handler(webapp2.RequestHandler):
         logging.info('Today is: ' + str(today))
 
         # Calculate device register count for every gcm app daily
-        apps = gcm_app.GcmAppModel.query(ancestor=ndb.Key(gcm_app.GcmAppModel, 'GcmApp'))
-        for app in apps:
-            app_package = app.key.string_id()
+        # All apps are read in batch: one call for counters, one for yesterday entities and one for today entities.
+        app_keys = gcm_app.GcmAppModel.query(ancestor=ndb.Key(gcm_app.GcmAppModel, 'GcmApp')).fetch(keys_only=True)
+        app_packages = [app_key.string_id() for app_key in app_keys]
+        total_counts = shard.get_counts([app_package + '_register' for app_package in app_packages])
+        yesterday_entities = ndb.get_multi([ndb.Key(gcm_app.GcmDeviceDailyCountModel,
+                                                    app_package + '_register_' + str(yesterday))
+                                            for app_package in app_packages])
+        today_entities = list()
+        for app_package, yesterday_entity in zip(app_packages, yesterday_entities):
             # today count = total count - count till yesterday
-            yesterday_entity = gcm_app.GcmDeviceDailyCountModel.get_by_id(app_package + '_register_' + str(yesterday))
             count_till_yesterday = 0 if yesterday_entity is None else yesterday_entity.countTillYesterday
-            total_count = shard.get_count(app_package + '_register')
+            total_count = total_counts[app_package + '_register']
             today_count = total_count - count_till_yesterday
 
             logging.info('package: %s, total: %d, till yesterday: %d, today: %d' %
@@ -52,4 +58,22 @@ class CronDaily0001Handler(webapp2.RequestHandler):
             today_entity = gcm_app.GcmDeviceDailyCountModel(id=app_package + '_register_' + str(today))
             today_entity.count = today_count
             today_entity.countTillYesterday = total_count
-            today_entity.put()
\ No newline at end of file
+            today_entities.append(today_entity)
+        ndb.put_multi(today_entities)
+
+
+class CronScaleCountersHandler(webapp2.RequestHandler):
+    def get(self):
+        # Add shards to counters whose shard writes collide often.
+        shard.scale_shards()
+
+
+class MigrateDevicesHandler(webapp2.RequestHandler):
+    def get(self):
+        """
+        Start the one-off device migration (see TaskQueueDeviceMigration). Not scheduled in cron.yaml, an admin visits
+        this url once after deploying.
+        """
+        taskqueue.add(url='/taskqueue/migrate_devices')
+        logging.info('Device migration started.')
+        self.response.write('Device migration started.')
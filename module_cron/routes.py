@@ -28,6 +28,10 @@ import handlers
 
 _routes = [
     RedirectRoute('/cron/daily_0001', handler=handlers.CronDaily0001Handler, name='cron-daily-0001', strict_slash=True),
+    RedirectRoute('/cron/scale_counters', handler=handlers.CronScaleCountersHandler, name='cron-scale-counters',
+                  strict_slash=True),
+    RedirectRoute('/cron/migrate_devices', handler=handlers.MigrateDevicesHandler, name='cron-migrate-devices',
+                  strict_slash=True),
 ]
 
 
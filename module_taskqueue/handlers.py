@@ -20,13 +20,22 @@
 # python import
 import logging
 import json
+import zlib
 
 # GAE import
 import webapp2
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
 # local import
+from models import gcm_app
+from lib import broadcast
+from lib import coalesce
 from lib import gcm_http
 from lib import parameter_helper
+from lib import shard
 
 
 class TaskQueueGcmSender(webapp2.RequestHandler):
@@ -39,10 +48,20 @@ class TaskQueueGcmSender(webapp2.RequestHandler):
          - try_count: indicates how many times we've tried. 0 means first time execution, not retry, and 1 is first
            retry, 2 is second retries, and so on...
          - api_key: the access token you generate in the Google Developers Console for this project.
-         - registration_ids: list of registration id of devices which you want sending message to.
+         - registration_ids: list of registration id of devices which you want sending message to. More than 1000
+           registration ids are split into several batches which are sent concurrently. When the
+           X-Gcm-Registration-Ids-Format header is present, they are encoded in the task body (see
+           gcm_http.encode_registration_ids), and the other parameters are in the query string.
+
+         - message: hash of the stored message (see GcmMessageModel), which holds the optional fields below.
 
          Optional
 
+         - package: apk package name of the app, retries are routed to its queues (see gcm_http.route_queue).
+         - deferrals: how many times the registration ids were deferred by gcm_http.SendGovernor, default 0.
+
+         Optional (carried as task parameters only by tasks pushed before messages were stored)
+
          - collapse_key:
          - delay_while_idle:
          - data:
@@ -59,18 +78,158 @@ class TaskQueueGcmSender(webapp2.RequestHandler):
             logging.error('We do not retry this way. Error happens at below code, need to fix it first...')
             return
 
+        registration_ids_format = headers.get(gcm_http.REGISTRATION_IDS_FORMAT_HEADER)
+        if registration_ids_format is not None:
+            params = self.request.GET
+            try:
+                registration_ids = gcm_http.decode_registration_ids(self.request.body, registration_ids_format)
+            except (ValueError, zlib.error) as e:
+                logging.error('Can not decode registration ids, drop this task: %s' % e)
+                return
+        else:
+            params = self.request.POST
+            registration_ids = params.getall('registration_ids')
+
+        logging.debug('[TaskQueue] task parameters: %s' % params)
+        api_key = params.get('api_key')
+        try_count = parameter_helper.to_int(params.get('try_count'), default=0)
+        message_hash = params.get('message')
+        if message_hash is not None:
+            message = gcm_app.GcmMessageModel.load(message_hash)
+            if message is None:
+                logging.error('Message %s does not exist, drop this task.' % message_hash)
+                return
+            collapse_key = message.get('collapse_key')
+            data = message.get('data')
+            delay_while_idle = message.get('delay_while_idle')
+            time_to_live = message.get('time_to_live')
+            restricted_package_name = message.get('restricted_package_name')
+            dry_run = message.get('dry_run', False)
+        else:
+            collapse_key = params.get('collapse_key')
+            data = json.loads(params.get('data', default='{}'))
+            delay_while_idle = parameter_helper.to_bool(params.get('delay_while_idle'))
+            time_to_live = parameter_helper.to_int(params.get('time_to_live'))
+            restricted_package_name = params.get('restricted_package_name')
+            dry_run = parameter_helper.to_bool(params.get('dry_run'), default=False)
+
+        batch_size = gcm_http.GCM.REGISTRATION_IDS_MAX
+        batches = [registration_ids[i:i + batch_size] for i in range(0, len(registration_ids), batch_size)]
+
+        deferrals = parameter_helper.to_int(params.get('deferrals'), default=0)
+        gcm = gcm_http.GCM(api_key, try_count, package=params.get('package'), deferrals=deferrals)
+        summary = gcm.send_many(batches, collapse_key=collapse_key, data=data, delay_while_idle=delay_while_idle,
+                                time_to_live=time_to_live, restricted_package_name=restricted_package_name,
+                                dry_run=dry_run, retry_task_name=headers.get('X-Appengine-Taskname'))
+        logging.info('[TaskQueue] %d registration ids sent, %s' % (len(registration_ids), summary))
+
+
+class TaskQueueBroadcastFanout(webapp2.RequestHandler):
+    def post(self):
+        """
+        Task parameters:
+
+         Required
+
+         - job_id: id of the broadcast job entity.
+         - segment: the segment of devices this task emits sender tasks for.
+
+        Unlike the sender task, a failed fan-out task is retried by task queue. It resumes from the cursor saved by the
+        previous segment.
+        """
+
         logging.debug('[TaskQueue] task parameters: %s' % self.request.POST)
-        api_key = self.request.POST.get('api_key')
-        try_count = parameter_helper.to_int(self.request.POST.get('try_count'), default=0)
-        registration_ids = self.request.POST.getall('registration_ids')
-        collapse_key = self.request.POST.get('collapse_key')
-        data = json.loads(self.request.POST.get('data', default='{}'))
-        delay_while_idle = parameter_helper.to_bool(self.request.POST.get('delay_while_idle'))
-        time_to_live = parameter_helper.to_int(self.request.POST.get('time_to_live'))
-        restricted_package_name = self.request.POST.get('restricted_package_name')
-        dry_run = parameter_helper.to_bool(self.request.POST.get('dry_run'), default=False)
-
-        gcm = gcm_http.GCM(api_key, try_count)
-        gcm.send(registration_ids, collapse_key=collapse_key, data=data, delay_while_idle=delay_while_idle,
-                 time_to_live=time_to_live, restricted_package_name=restricted_package_name, dry_run=dry_run)
+        job_id = parameter_helper.to_int(self.request.POST.get('job_id'))
+        segment = parameter_helper.to_int(self.request.POST.get('segment'), default=0)
+        if job_id is None:
+            logging.error('Missing job_id, drop this task.')
+            return
+
+        broadcast.run_segment(job_id, segment)
+
+
+class TaskQueueCoalescedSender(webapp2.RequestHandler):
+    def post(self):
+        """
+        No task parameters. Send the items queued by coalesce.push() in the pull queue, grouped by api key and message.
+        """
+        coalesce.run()
+
+
+class TaskQueueCounterIncrement(webapp2.RequestHandler):
+
+    DEDUP_KEY_TEMPLATE = 'counter-task-{}'
+    DEDUP_SECONDS = 24 * 60 * 60
+
+    def post(self):
+        """
+        Task parameters:
+
+         Required
+
+         - name: name of the sharded counter to increase.
+
+         Optional
+
+         - delta: how much to increase, default 1.
+
+        The counter is increased exactly, a failed transaction fails the task and task queue retries it. A task may run
+        more than once, so the task name is remembered and a task which was applied already is skipped.
+        """
+
+        name = self.request.POST.get('name')
+        delta = parameter_helper.to_int(self.request.POST.get('delta'), default=1)
+        if name is None:
+            logging.error('Missing name, drop this task.')
+            return
+
+        dedup_key = self.DEDUP_KEY_TEMPLATE.format(self.request.headers.get('X-Appengine-Taskname'))
+        if memcache.get(dedup_key) is not None:
+            logging.info('Counter %s was increased by this task before, skip it.' % name)
+            return
+        shard.increment(name, delta=delta)
+        memcache.set(dedup_key, 1, time=self.DEDUP_SECONDS)
+
 
+class TaskQueueDeviceMigration(webapp2.RequestHandler):
+
+    URL = '/taskqueue/migrate_devices'
+    BATCH_SIZE = 500
+
+    def post(self):
+        """
+        One-off migration re-putting every device entity, so entities written before the enabled property existed get
+        enabled=True stored and indexed (broadcast and device listing filter on it), and uuid gets indexed (device
+        listing projects it). Devices are re-put by GcmDeviceMigrationModel, so timestamp keeps its value and the
+        device listing order is not changed.
+
+        Task parameters:
+
+         Optional
+
+         - cursor: urlsafe cursor where this batch starts. The first batch has no cursor.
+        """
+
+        cursor = self.request.POST.get('cursor')
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+        q = gcm_app.GcmDeviceModel.query().order(gcm_app.GcmDeviceModel.key)
+        keys, next_cursor, more = q.fetch_page(self.BATCH_SIZE, start_cursor=start_cursor, keys_only=True)
+        # every device in its own transaction, so a device changed since the query is not overwritten
+        for future in [self.migrate_device_async(key) for key in keys]:
+            # a failed transaction fails the task, task queue retries the batch
+            future.check_success()
+        logging.info('Migrated %d devices.' % len(keys))
+
+        if more and next_cursor is not None:
+            taskqueue.add(url=self.URL, params={'cursor': next_cursor.urlsafe()})
+        else:
+            logging.info('Device migration done.')
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def migrate_device_async(key):
+        device = yield key.get_async()
+        if device is None:
+            return
+        # re-put by GcmDeviceMigrationModel, which writes every property explicitly and keeps timestamp
+        yield gcm_app.GcmDeviceMigrationModel.from_device(device).put_async()
@@ -24,9 +24,21 @@ from webapp2_extras.routes import RedirectRoute
 
 # local import
 from handlers import TaskQueueGcmSender
+from handlers import TaskQueueBroadcastFanout
+from handlers import TaskQueueCoalescedSender
+from handlers import TaskQueueCounterIncrement
+from handlers import TaskQueueDeviceMigration
 
 _routes = [
     RedirectRoute(r'/taskqueue/gcm_sender', handler=TaskQueueGcmSender, name='gcm-sender', strict_slash=True),
+    RedirectRoute(r'/taskqueue/broadcast_fanout', handler=TaskQueueBroadcastFanout, name='broadcast-fanout',
+                  strict_slash=True),
+    RedirectRoute(r'/taskqueue/coalesced_sender', handler=TaskQueueCoalescedSender, name='coalesced-sender',
+                  strict_slash=True),
+    RedirectRoute(r'/taskqueue/counter_increment', handler=TaskQueueCounterIncrement, name='counter-increment',
+                  strict_slash=True),
+    RedirectRoute(TaskQueueDeviceMigration.URL, handler=TaskQueueDeviceMigration, name='migrate-devices',
+                  strict_slash=True),
 ]
 
 